@@ -0,0 +1,230 @@
+"""
+A compact, read-only, columnar representation of the whole APOD archive.
+
+Instead of one dict per entry, the archive holds a handful of flat arrays:
+the date ordinals, a bitmask of the fields each entry has, the media types as
+one byte each, and every text field as a single utf-8 blob with an array of
+offsets into it. Keywords are ids into a table of distinct keywords.
+
+The arrays are laid out in one buffer, which is also the file format, so a
+saved archive is loaded by mapping the file: nothing is parsed or copied, and
+every worker process mapping the same file shares the same pages. Entries are
+turned back into dicts (like the ones parse_apod returns) only when asked for.
+The file uses the native byte order; build it on the architecture serving it.
+"""
+
+from array import array
+from datetime import date
+import bisect
+import json
+import mmap
+import struct
+
+try:
+    import store
+except ImportError:
+    from apod import store
+
+MAGIC = b'APODARC1'
+_HEADER_LENGTH = struct.Struct('<I')
+
+# fields of the emitted dicts, in the order parse_apod puts them
+FIELDS = ('explanation', 'title', 'media_type', 'date', 'copyright', 'keywords', 'url', 'hdurl', 'thumbnail_url')
+STRING_FIELDS = ('explanation', 'title', 'copyright', 'url', 'hdurl', 'thumbnail_url')
+# fields an entry may lack or have as None: two bits each in its flags
+OPTIONAL_FIELDS = STRING_FIELDS + ('keywords', 'media_type')
+
+NO_MEDIA_TYPE = 255
+
+
+def _present(field):
+    return 1 << (2 * OPTIONAL_FIELDS.index(field))
+
+
+def _null(field):
+    return 2 << (2 * OPTIONAL_FIELDS.index(field))
+
+
+def _aligned(offset):
+    return (offset + 7) & ~7
+
+
+def _strings_section(values):
+    # one blob of utf-8 text and the offsets of each value in it
+    offsets, blob = array('I', [0]), bytearray()
+    for value in values:
+        blob += (value or '').encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, blob
+
+
+class CompactArchive(object):
+    """
+    The APOD entries of many dates, read from a buffer built by `build` (or
+    mapped from a file written by `save`).
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError('Not an APOD archive')
+        header_length, = _HEADER_LENGTH.unpack_from(buffer, len(MAGIC))
+        header_start = len(MAGIC) + _HEADER_LENGTH.size
+        header = json.loads(bytes(view[header_start:header_start + header_length]).decode('utf-8'))
+
+        base = _aligned(header_start + header_length)
+        self._buffer = buffer
+        self._media_types = header['media_types']
+        self._sections = dict((name, view[base + offset:base + offset + size].cast(typecode))
+                              for name, (typecode, offset, size) in header['sections'].items())
+        self._ordinals = self._sections['ordinals']
+        self._flags = self._sections['flags']
+
+    @classmethod
+    def build(cls, entries):
+        """
+        Returns the archive of (date, entry) pairs, in any order. Of several
+        entries for a date, the last one is kept.
+        """
+        by_ordinal = dict((dt.toordinal(), data) for dt, data in entries)
+        ordinals = sorted(by_ordinal)
+        datas = [by_ordinal[ordinal] for ordinal in ordinals]
+
+        flags = array('H')
+        for data in datas:
+            bits = 0
+            for field in OPTIONAL_FIELDS:
+                if field in data:
+                    bits |= _present(field)
+                    if data[field] is None:
+                        bits |= _null(field)
+            flags.append(bits)
+
+        media_types = sorted(set(data['media_type'] for data in datas if data.get('media_type')))
+        media_codes = array('B', (media_types.index(data['media_type']) if data.get('media_type') else NO_MEDIA_TYPE
+                                  for data in datas))
+
+        keyword_ids, keyword_offsets, keyword_names = array('I'), array('I', [0]), {}
+        for data in datas:
+            for keyword in data.get('keywords') or ():
+                keyword_ids.append(keyword_names.setdefault(keyword, len(keyword_names)))
+            keyword_offsets.append(len(keyword_ids))
+
+        sections = [('ordinals', array('i', ordinals)), ('flags', flags), ('media_types', media_codes),
+                    ('keywords.offsets', keyword_offsets), ('keywords.ids', keyword_ids)]
+        names_offsets, names_blob = _strings_section(sorted(keyword_names, key=keyword_names.get))
+        sections += [('keyword_names.offsets', names_offsets), ('keyword_names.data', names_blob)]
+        for field in STRING_FIELDS:
+            offsets, blob = _strings_section(data.get(field) for data in datas)
+            sections += [(field + '.offsets', offsets), (field + '.data', blob)]
+
+        return cls(cls._pack(sections, media_types))
+
+    @staticmethod
+    def _pack(sections, media_types):
+        layout, offset = {}, 0
+        for name, values in sections:
+            typecode = values.typecode if isinstance(values, array) else 'B'
+            size = len(values) * (values.itemsize if isinstance(values, array) else 1)
+            layout[name] = [typecode, offset, size]
+            offset = _aligned(offset + size)
+        header = json.dumps({'count': len(sections[0][1]), 'media_types': media_types,
+                             'sections': layout}).encode('utf-8')
+
+        buffer = bytearray(MAGIC + _HEADER_LENGTH.pack(len(header)) + header)
+        base = _aligned(len(buffer))
+        buffer += bytes(base + offset - len(buffer))
+        for name, values in sections:
+            typecode, start, size = layout[name]
+            buffer[base + start:base + start + size] = bytes(values) if not isinstance(values, array) \
+                else values.tobytes()
+        return bytes(buffer)
+
+    def save(self, path):
+        """
+        Writes the archive to a file, atomically.
+        """
+        with store.atomic_file(path) as file:
+            file.write(self._buffer)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the archive saved in the file, mapped in memory.
+        """
+        with open(path, 'rb') as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def __contains__(self, dt):
+        return self._index_of(dt) is not None
+
+    def _index_of(self, dt):
+        idx = bisect.bisect_left(self._ordinals, dt.toordinal())
+        if idx < len(self._ordinals) and self._ordinals[idx] == dt.toordinal():
+            return idx
+        return None
+
+    def dates(self):
+        """
+        Returns the dates in the archive, in order.
+        """
+        return [date.fromordinal(ordinal) for ordinal in self._ordinals]
+
+    def _string(self, name, idx):
+        offsets = self._sections[name + '.offsets']
+        return str(self._sections[name + '.data'][offsets[idx]:offsets[idx + 1]], 'utf-8')
+
+    def _value(self, field, idx):
+        if field == 'date':
+            return date.fromordinal(self._ordinals[idx]).isoformat()
+        elif field == 'media_type':
+            return self._media_types[self._sections['media_types'][idx]]
+        elif field == 'keywords':
+            offsets, ids = self._sections['keywords.offsets'], self._sections['keywords.ids']
+            return [self._string('keyword_names', ids[pos]) for pos in range(offsets[idx], offsets[idx + 1])]
+        return self._string(field, idx)
+
+    def _entry(self, idx, fields):
+        bits = self._flags[idx]
+        props = {}
+        for field in fields:
+            if field != 'date':
+                if not bits & _present(field):
+                    continue
+                if bits & _null(field):
+                    props[field] = None
+                    continue
+            props[field] = self._value(field, idx)
+        return props
+
+    @staticmethod
+    def _fields(fields):
+        # emitted in parse_apod's order whatever the order asked for
+        if fields is None:
+            return FIELDS
+        return tuple(field for field in FIELDS if field in fields)
+
+    def get(self, dt, fields=None):
+        """
+        Returns the entry of the date as a dict, with only the given fields if
+        any. Raises KeyError if the date isn't in the archive.
+        """
+        idx = self._index_of(dt)
+        if idx is None:
+            raise KeyError(dt)
+        return self._entry(idx, self._fields(fields))
+
+    def range(self, start_dt, end_dt, fields=None):
+        """
+        Yields (date, entry) for the dates from start_dt to end_dt (inclusive)
+        in the archive, in order, the entries having only the given fields if
+        any.
+        """
+        fields = self._fields(fields)
+        first = bisect.bisect_left(self._ordinals, start_dt.toordinal())
+        last = bisect.bisect_right(self._ordinals, end_dt.toordinal())
+        for idx in range(first, last):
+            yield date.fromordinal(self._ordinals[idx]), self._entry(idx, fields)
@@ -0,0 +1,208 @@
+"""
+Asyncio engine filling the cache for many dates at once (cold range fills).
+
+A single event loop per process, running in a background thread, drives all
+downloads. The blocking HTTP calls run on one shared, bounded executor, which
+caps the number of concurrent upstream fetches for the whole process no matter
+how many range requests are in flight. Parsing is handed to a second bounded
+executor so that slow pages do not hold up downloads. Parsing is pure Python
+and CPU bound; with APOD_PARSE_MODE=process it runs on a pool of worker
+processes, started once per process and reused, so that it scales with cores.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+
+try:
+    import metrics
+    import perprocess
+    import utility
+except ImportError:
+    from apod import metrics, perprocess, utility
+
+LOG = logging.getLogger(__name__)
+
+# maximum number of concurrent upstream fetches per process
+FETCH_CONCURRENCY = int(os.environ.get('APOD_FETCH_CONCURRENCY', 32))
+# number of workers parsing downloaded pages
+PARSE_WORKERS = int(os.environ.get('APOD_PARSE_WORKERS', os.cpu_count() or 1))
+# 'thread' (parse in this process) or 'process' (parse in worker processes)
+PARSE_MODE = os.environ.get('APOD_PARSE_MODE', 'thread')
+
+
+def parse_executor(mode=PARSE_MODE, workers=PARSE_WORKERS):
+    """
+    Returns a new executor for parsing pages.
+    """
+    if mode == 'thread':
+        return ThreadPoolExecutor(workers)
+    elif mode == 'process':
+        if sys.version_info >= (3, 7):
+            # the fetcher runs threads, don't fork them into the workers
+            return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        return ProcessPoolExecutor(workers)
+    else:
+        raise ValueError('Unknown parse mode %s, expected thread or process' % mode)
+
+
+class Fetcher(object):
+    """
+    Downloads, parses and caches APOD entries on a background event loop.
+    """
+
+    def __init__(self, concurrency=FETCH_CONCURRENCY, parse_mode=PARSE_MODE, parse_workers=PARSE_WORKERS):
+        self._io = ThreadPoolExecutor(concurrency)
+        self._parser = parse_executor(parse_mode, parse_workers)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='apod-fetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, dt, use_default_today_date=False, cache=True):
+        """
+        Schedules the download of one date. Returns a concurrent.futures.Future
+        resolving to the APOD properties, or None if they can't be had.
+        """
+        return asyncio.run_coroutine_threadsafe(self.download(dt, use_default_today_date, cache), self._loop)
+
+    def map(self, dates, cache=True):
+        """
+        Accepts (date, use_default_today_date) tuples and yields the result of
+        each one, in order, as soon as it is available. Downloads still
+        pending when the generator is closed are cancelled.
+        """
+        futures = [self.submit(dt, use_default_today_date, cache) for dt, use_default_today_date in dates]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def download(self, dt, use_default_today_date=False, cache=True):
+        """
+        Coroutine returning the APOD properties of a date and caching them
+        (unless `cache` is False, for callers writing the cache in bulk), or
+        None if they can't be had. Like parse_apod, falls back to the day
+        before when asked for today's date and that page isn't up yet.
+
+        Concurrent downloads of the same date (from this or any other request
+        of the process) share a single fetch and parse. The shared fetch runs
+        in a task of its own, which goes on when the download that started it
+        is cancelled (e.g. its client went away), so that the others waiting
+        on it still get the entry.
+        """
+        try:
+            try:
+                return await self._run_in(self._io, utility.cached_json_for, dt)
+            except Exception:
+                pass
+
+            key = (dt, use_default_today_date)
+            while True:
+                future, leader = utility.fill_flights.claim(key)
+                if leader:
+                    break
+                waiter = asyncio.wrap_future(future)
+                try:
+                    # never cancel the shared future along with this download
+                    return dict(await asyncio.shield(waiter))
+                except asyncio.CancelledError:
+                    if not future.cancelled():
+                        raise
+                    # its leader was cancelled (shutting down), take over
+
+            fill = asyncio.ensure_future(self._lead(key, dt, use_default_today_date, cache))
+            data = await asyncio.shield(fill)
+            return dict(data) if data is not None else None
+
+        except Exception as ex:
+            LOG.error('Could not download ' + str(dt) + ': ' + str(ex))
+            return None
+
+    async def _lead(self, key, dt, use_default_today_date, cache):
+        # fills the cache for everyone waiting on the key, None on failure
+        try:
+            data = await self._fill(dt, use_default_today_date, cache)
+        except BaseException as ex:
+            utility.fill_flights.resolve(key, error=ex)
+            if not isinstance(ex, Exception):
+                raise
+            LOG.error('Could not download ' + str(dt) + ': ' + str(ex))
+            return None
+        utility.fill_flights.resolve(key, data)
+        return data
+
+    async def _fill(self, dt, use_default_today_date, cache):
+        try:
+            data = await self._apod_chars(dt)
+        except Exception as ex:
+            if not use_default_today_date:
+                raise
+            LOG.debug('falling back to the day before ' + str(dt) + ': ' + str(ex))
+            data = await self._apod_chars(dt - timedelta(days=1))
+
+        if cache:
+            await self._run_in(self._io, utility.cache_json, data, dt)
+        return data
+
+    async def _apod_chars(self, dt):
+        await self._run_in(self._io, utility._check_negative, dt)
+        try:
+            html_content = await self._run_in(self._io, utility._get_apod_html, dt)
+            return await self._run_in(self._parser, utility._apod_chars_from, html_content, dt)
+        except Exception as ex:
+            await self._run_in(self._io, utility._remember_failure, dt, ex)
+            raise
+
+    async def _run_in(self, executor, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+
+    def queue_depths(self):
+        """
+        Returns the number of tasks waiting for an io and a parsing worker.
+        """
+        depths = {('io',): self._io._work_queue.qsize()}
+        if isinstance(self._parser, ThreadPoolExecutor):
+            depths[('parse',)] = self._parser._work_queue.qsize()
+        else:
+            depths[('parse',)] = len(self._parser._pending_work_items)
+        return depths
+
+    def shutdown(self):
+        """
+        Stops the event loop and the executors.
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._io.shutdown()
+        self._parser.shutdown()
+
+
+_fetcher = perprocess.PerProcess(Fetcher)
+
+
+def fetcher():
+    """
+    Returns the fetcher of this process, starting it on first use.
+    """
+    return _fetcher.get()
+
+
+def _queue_depths():
+    # only this process's own fetcher, never one inherited through a fork
+    apod_fetcher = _fetcher.peek()
+    return apod_fetcher.queue_depths() if apod_fetcher is not None else {}
+
+
+metrics.FETCHER_QUEUE_DEPTH.set_function(_queue_depths)
@@ -0,0 +1,65 @@
+"""
+Classification of the video urls found on APOD pages.
+
+The patterns are compiled once, at import, and every url is first checked for
+the provider's name so that the (backtracking) YouTube pattern only runs on
+urls that can match it. Classifications are memoized: the same embeds show up
+again and again when the archive is (re)processed.
+"""
+
+from collections import namedtuple
+import functools
+import re
+
+# provider: 'youtube', 'vimeo', 'file' (a video file served as is) or 'other'
+# id: the provider's video id, None if there is none
+# thumbnail: the thumbnail url if it is known without a lookup, None otherwise
+Media = namedtuple('Media', ['provider', 'id', 'thumbnail'])
+
+YOUTUBE = re.compile(r"(?:http:|https:)*?\/\/(?:www\.|)(?:youtube\.com|m\.youtube\.com|youtu\.|youtube-nocookie\.com).*(?:v=|v%3D|v\/|(?:a|p)\/(?:a|u)\/\d.*\/|watch\?|vi(?:=|\/)|\/embed\/|oembed\?|be\/|e\/)([^&?%#\/\n]*)")
+VIMEO = re.compile(r"(?:/video/)(\d+)")
+VIDEO_FILE = re.compile(r"\.(?:mp4|m4v|webm|ogv|ogg|mov)(?:[?#]|$)", re.IGNORECASE)
+
+YOUTUBE_THUMBNAIL = "https://img.youtube.com/vi/{}/0.jpg"
+
+# size of the memo of classified urls
+CACHE_SIZE = 4096
+
+
+def youtube_id(url):
+    """
+    Returns the YouTube video id in the url, or an empty string.
+    """
+    # every url the pattern matches names the host, skip the regex otherwise
+    if not url or 'youtu' not in url:
+        return ''
+    return ''.join(YOUTUBE.findall(url))
+
+
+def vimeo_id(url):
+    """
+    Returns the Vimeo video id in the url, or None.
+    """
+    if not url or 'vimeo' not in url:
+        return None
+    match = VIMEO.search(url)
+    return match.group(1) if match else None
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def classify(url):
+    """
+    Returns the Media (provider, id and thumbnail) of a video url.
+    """
+    video_id = youtube_id(url)
+    if video_id:
+        return Media('youtube', video_id, YOUTUBE_THUMBNAIL.format(video_id))
+
+    if url and 'vimeo' in url:
+        # the thumbnail takes an API call, see utility._get_thumbs
+        return Media('vimeo', vimeo_id(url), None)
+
+    if url and VIDEO_FILE.search(url):
+        return Media('file', None, None)
+
+    return Media('other', None, None)
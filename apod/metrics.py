@@ -0,0 +1,375 @@
+"""
+Counters, histograms and gauges of the service, exposed in the Prometheus
+text format on /metrics.
+
+Updating a metric only touches a dict in memory, under a lock of its own.
+Every process (gunicorn workers, parsing processes) writes a snapshot of its
+metrics to a file of its own under METRICS_FOLDER every FLUSH_INTERVAL
+seconds, and /metrics adds up the snapshots of all of them, so whichever
+worker is scraped reports the whole service. The snapshots of processes that
+are gone are folded into a single one (EXITED), so their counters and
+histograms keep counting without leaving a file behind per process; gauges
+only come from live processes. Clear METRICS_FOLDER when redeploying to start
+from zero.
+"""
+
+from collections import OrderedDict
+import atexit
+import bisect
+import fcntl
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import perprocess
+    import store
+except ImportError:
+    from apod import perprocess, store
+
+LOG = logging.getLogger(__name__)
+
+# collect metrics at all, 0 to disable
+METRICS = bool(int(os.environ.get('APOD_METRICS', 1)))
+METRICS_FOLDER = os.environ.get('APOD_METRICS_FOLDER',
+                                os.path.join(os.environ.get('APOD_CACHE_FOLDER', 'cache'), 'metrics'))
+# seconds between two snapshots of a process's metrics
+FLUSH_INTERVAL = float(os.environ.get('APOD_METRICS_FLUSH_INTERVAL', 5))
+
+# snapshot adding up the processes that are gone
+EXITED = 'exited.json'
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+DAYS_BUCKETS = (1, 7, 31, 100, 366, 1000, 3000, 10000)
+
+_registry = OrderedDict()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def _snapshot(self):
+        return {'type': self.kind, 'help': self.documentation, 'labels': list(self.labelnames),
+                'samples': self._samples()}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not METRICS:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _flusher()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not METRICS:
+            return
+        key = self._key(labels)
+        # one count per bucket (the last one being +Inf), then the sum
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[idx] += 1
+            values[-1] += value
+        _flusher()
+
+    def time(self, **labels):
+        """
+        Returns a context manager observing the time spent in its block.
+        """
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """
+        Decorator observing the time spent in each call of a function.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def _snapshot(self):
+        snapshot = super(Histogram, self)._snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Gauge(_Metric):
+    """
+    A gauge read from a function when the metrics are collected. The function
+    returns {label values tuple: value}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._function = dict
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        try:
+            return [[list(key), value] for key, value in self._function().items()]
+        except Exception as ex:
+            LOG.error('Could not read ' + self.name + ': ' + str(ex))
+            return []
+
+
+# Metrics of the service
+
+UPSTREAM_SECONDS = Histogram('apod_upstream_request_seconds', 'Time of requests to apod.nasa.gov.')
+UPSTREAM_ERRORS = Counter('apod_upstream_errors_total',
+                          'Failed requests to apod.nasa.gov, by HTTP status or exception.', ['reason'])
+PARSE_SECONDS = Histogram('apod_parse_seconds', 'Time spent parsing APOD pages, by stage.', ['stage'])
+CACHE_SECONDS = Histogram('apod_cache_seconds', 'Time of JSON cache reads and writes.', ['operation'])
+CACHE_LOOKUPS = Counter('apod_cache_lookups_total',
+                        'Lookups of entries: memory_hit, store_hit, miss or negative (known unusable date).',
+                        ['result'])
+SERIALIZE_SECONDS = Histogram('apod_serialize_seconds', 'Time spent serializing response bodies.', ['kind'])
+RANGE_DAYS = Histogram('apod_range_days', 'Number of days asked for by range requests.', buckets=DAYS_BUCKETS)
+FETCHER_QUEUE_DEPTH = Gauge('apod_fetcher_queue_depth', 'Tasks waiting for a fetcher worker, by pool.', ['pool'])
+
+
+# Snapshots
+
+_stopped = threading.Event()
+
+
+def _flusher_thread():
+    thread = threading.Thread(target=_flush_periodically, name='apod-metrics')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+_flushers = perprocess.PerProcess(_flusher_thread)
+
+
+def _flusher():
+    _flushers.get()
+
+
+def _flush_periodically():
+    # a snapshot left by an earlier process with our pid would be overwritten
+    try:
+        _fold([_snapshot_path(os.getpid())])
+    except Exception as ex:
+        LOG.error('Could not fold the metrics: ' + str(ex))
+    while not _stopped.wait(FLUSH_INTERVAL):
+        try:
+            flush()
+        except Exception as ex:
+            LOG.error('Could not write the metrics: ' + str(ex))
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_FOLDER, '%d.json' % pid)
+
+
+def _write(path, snapshot):
+    if not os.path.exists(METRICS_FOLDER):
+        os.makedirs(METRICS_FOLDER)
+    with store.atomic_file(path, 'w') as file:
+        json.dump(snapshot, file)
+
+
+def _load(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def flush():
+    """
+    Writes the snapshot of this process's metrics.
+    """
+    snapshot = {'pid': os.getpid(),
+                'metrics': dict((name, metric._snapshot()) for name, metric in _registry.items())}
+    _write(_snapshot_path(os.getpid()), snapshot)
+
+
+@atexit.register
+def _flush_at_exit():
+    if METRICS and _flushers.peek() is not None:
+        try:
+            flush()
+        except Exception:
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _add(merged, snapshot, gauges=True):
+    """
+    Adds the metrics of a snapshot to `merged`, {name: metric} with the
+    samples of each metric as {label values tuple: value}.
+    """
+    for name, metric in snapshot['metrics'].items():
+        if metric['type'] == 'gauge' and not gauges:
+            continue
+        total = merged.setdefault(name, dict(metric, samples=OrderedDict()))
+        for labels, value in metric['samples']:
+            key = tuple(labels)
+            if metric['type'] == 'histogram':
+                previous = total['samples'].get(key)
+                if previous is not None and len(previous) == len(value):
+                    value = [a + b for a, b in zip(previous, value)]
+                total['samples'][key] = value
+            else:
+                total['samples'][key] = total['samples'].get(key, 0) + value
+
+
+def _fold(paths):
+    """
+    Adds the snapshots at the paths, of processes that are gone, to the
+    EXITED snapshot and removes them.
+    """
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return
+    fd = os.open(os.path.join(METRICS_FOLDER, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # scrapes of several workers may find the same snapshots
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        exited_path = os.path.join(METRICS_FOLDER, EXITED)
+        merged = OrderedDict()
+        exited = _load(exited_path)
+        if exited is not None:
+            _add(merged, exited)
+        snapshots = [(path, _load(path)) for path in paths]
+        snapshots = [(path, snapshot) for path, snapshot in snapshots if snapshot is not None]
+        if not snapshots:
+            return
+        for path, snapshot in snapshots:
+            _add(merged, snapshot, gauges=False)
+
+        metrics = dict((name, dict(metric, samples=[[list(key), value] for key, value in metric['samples'].items()]))
+                       for name, metric in merged.items())
+        _write(exited_path, {'pid': None, 'metrics': metrics})
+        for path, snapshot in snapshots:
+            os.remove(path)
+    finally:
+        os.close(fd)
+
+
+def _merged():
+    merged = OrderedDict()
+    gone = []
+    for path in sorted(glob.glob(os.path.join(METRICS_FOLDER, '*.json'))):
+        snapshot = _load(path)
+        if snapshot is None:
+            continue
+        alive = snapshot['pid'] is not None and _alive(snapshot['pid'])
+        if snapshot['pid'] is not None and not alive:
+            gone.append(path)
+        _add(merged, snapshot, gauges=alive)
+
+    if gone:
+        try:
+            _fold(gone)
+        except Exception as ex:
+            LOG.error('Could not fold the metrics: ' + str(ex))
+    return merged
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition():
+    """
+    Returns the metrics of every process, in the Prometheus text format.
+    """
+    flush()
+    lines = []
+    for name, metric in _merged().items():
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['type']))
+        for key, value in metric['samples'].items():
+            if metric['type'] != 'histogram':
+                lines.append('%s%s %s' % (name, _labels(metric['labels'], key), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric['buckets'] + [float('inf')], value[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(metric['labels'], key, [('le', _number(bound))]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, _labels(metric['labels'], key), _number(value[-1])))
+            lines.append('%s_count%s %d' % (name, _labels(metric['labels'], key), cumulative))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,41 @@
+"""
+Objects every process needs its own of.
+
+Threads don't survive a fork, and sockets or executors shared with a parent
+process would be used by both: gunicorn workers are forked from the arbiter,
+which with --preload has imported (and maybe used) the service already.
+"""
+
+import os
+import threading
+
+
+class PerProcess(object):
+    """
+    Holds the object made by factory(), made on first use in every process
+    (again in a forked child, on its own first use).
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the object of this process, making it if there is none yet.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def peek(self):
+        """
+        Returns the object of this process, None if it hasn't been made (it
+        may have been in a parent process).
+        """
+        return self._value if self._pid == os.getpid() else None
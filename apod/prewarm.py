@@ -0,0 +1,114 @@
+"""
+Offline builder filling the HTML and JSON caches for every APOD date, so that
+a new deploy can ship a warm cache instead of taking the cold-start hit.
+
+Dates already in the JSON cache are skipped, so an interrupted run simply
+resumes where it stopped when started again.
+
+    apod-prewarm --start 1995-06-16 --concurrency 32 --parse-mode process
+"""
+
+from datetime import date, datetime
+import argparse
+import sys
+import time
+
+try:
+    import fetcher
+    import utility
+    from store import FIRST_DATE
+except ImportError:
+    from apod import fetcher, utility
+    from apod.store import FIRST_DATE
+
+# number of dates fetched before writing them to the cache and reporting
+BATCH_SIZE = 500
+
+
+def _date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def missing_dates(start, end):
+    """
+    Returns the dates from start to end (inclusive) not in the JSON cache.
+    """
+    missing = []
+    for chunk_start in range(start.toordinal(), end.toordinal() + 1, BATCH_SIZE):
+        chunk_end = min(chunk_start + BATCH_SIZE - 1, end.toordinal())
+        entries = utility.cached_json_range(date.fromordinal(chunk_start), date.fromordinal(chunk_end))
+        missing.extend(date.fromordinal(chunk_start + idx) for idx, entry in enumerate(entries) if entry is None)
+    return missing
+
+
+def prewarm(start, end, apod_fetcher, report=print):
+    """
+    Fetches, parses and caches every missing date from start to end. Returns
+    the number of dates cached and the number of dates that failed.
+    """
+    missing = missing_dates(start, end)
+    report('%d of %d dates missing from the cache' % (len(missing), end.toordinal() - start.toordinal() + 1))
+
+    cached = failed = 0
+    began = time.time()
+    for idx in range(0, len(missing), BATCH_SIZE):
+        batch = missing[idx:idx + BATCH_SIZE]
+        apods = list(apod_fetcher.map([(dt, False) for dt in batch], cache=False))
+
+        found = [(data, dt) for data, dt in zip(apods, batch) if data]
+        utility.cache_json_many(found)
+        cached += len(found)
+        failed += len(batch) - len(found)
+
+        elapsed = time.time() - began
+        report('%d/%d dates done (%d failed), %.1f dates/s' % (
+            idx + len(batch), len(missing), failed, (idx + len(batch)) / elapsed if elapsed else 0))
+
+    return cached, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fill the APOD caches for a range of dates.')
+    parser.add_argument('--start', type=_date, default=FIRST_DATE,
+                        help='first date to cache, YYYY-MM-DD (default: %(default)s)')
+    parser.add_argument('--end', type=_date, default=datetime.today().date(),
+                        help='last date to cache, YYYY-MM-DD (default: today)')
+    parser.add_argument('--concurrency', type=int, default=fetcher.FETCH_CONCURRENCY,
+                        help='maximum number of concurrent downloads (default: %(default)s)')
+    parser.add_argument('--parse-mode', choices=('thread', 'process'), default='process',
+                        help='parse pages in threads or worker processes (default: %(default)s)')
+    parser.add_argument('--parse-workers', type=int, default=fetcher.PARSE_WORKERS,
+                        help='number of parsing threads or processes (default: %(default)s)')
+    parser.add_argument('--reindex', action='store_true',
+                        help='only rebuild the search indexes from the JSON cache')
+    parser.add_argument('--archive', metavar='PATH',
+                        help='only write the compact archive of the JSON cache to PATH')
+    parser.add_argument('--compact', action='store_true',
+                        help='only compact the packed caches (APOD_CACHE_BACKEND=packed), with the service stopped')
+    args = parser.parse_args(argv)
+
+    if args.reindex:
+        print('indexed %d dates' % utility.reindex())
+        return 0
+    if args.compact:
+        print('freed %d bytes' % utility.compact_stores())
+        return 0
+    if args.archive:
+        print('archived %d dates' % utility.build_archive(args.archive))
+        return 0
+
+    if args.start > args.end:
+        parser.error('--start cannot be after --end')
+
+    apod_fetcher = fetcher.Fetcher(args.concurrency, args.parse_mode, args.parse_workers)
+    try:
+        cached, failed = prewarm(max(args.start, FIRST_DATE), args.end, apod_fetcher)
+    finally:
+        apod_fetcher.shutdown()
+
+    print('cached %d dates, %d failed' % (cached, failed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
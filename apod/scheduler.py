@@ -0,0 +1,205 @@
+"""
+Background prefetching of the new day's APOD, so that no client request pays
+for fetching and parsing it.
+
+Around midnight US Eastern time (when the APOD site rolls over) the scheduler
+polls for the new page, backing off between attempts until it is up, then
+parses it and publishes it to the cache through cache_json, whose writes are
+atomic. Until the next rollover it keeps revalidating the recent entries just
+before they expire, so that they are always served from the cache.
+
+Only one scheduler polls at a time: all of them (e.g. one per gunicorn worker)
+try to take a lock file without blocking, and the others stand by in case the
+leader goes away. Enable it in the service with APOD_PREFETCH=1, or run it as
+a sidecar process:
+
+    apod-prefetch
+"""
+
+from datetime import datetime, timedelta, timezone
+import argparse
+import fcntl
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import perprocess
+    import utility
+except ImportError:
+    from apod import perprocess, utility
+
+try:
+    from zoneinfo import ZoneInfo
+    EASTERN = ZoneInfo('America/New_York')
+except (ImportError, KeyError):
+    # no tz database: EDT all year round, which in winter only means that
+    # polling starts an hour before the page can be up
+    EASTERN = timezone(timedelta(hours=-4))
+
+LOG = logging.getLogger(__name__)
+
+# run the scheduler in the service processes
+PREFETCH = bool(int(os.environ.get('APOD_PREFETCH', 0)))
+# seconds between the first polls for the new page, doubled after every miss
+PREFETCH_POLL_INTERVAL = float(os.environ.get('APOD_PREFETCH_POLL_INTERVAL', 60))
+# longest wait between two polls, in seconds
+PREFETCH_MAX_INTERVAL = float(os.environ.get('APOD_PREFETCH_MAX_INTERVAL', 1800))
+
+LOCK_PATH = os.path.join(utility.CACHE_FOLDER, 'scheduler.lock')
+
+
+def eastern_now():
+    return datetime.now(EASTERN)
+
+
+def seconds_until_rollover(now=None):
+    """
+    Returns the number of seconds until the next midnight, US Eastern time.
+    """
+    now = now or eastern_now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time()).replace(tzinfo=now.tzinfo)
+    return (midnight - now).total_seconds()
+
+
+class Scheduler(object):
+    """
+    Polls for, publishes and refreshes the recent APOD entries.
+    """
+
+    def __init__(self, lock_path=LOCK_PATH, poll_interval=PREFETCH_POLL_INTERVAL, max_interval=PREFETCH_MAX_INTERVAL):
+        self.lock_path = lock_path
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self._lock_fd = None
+        self._day = None
+        self._misses = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def is_leader(self):
+        """
+        Whether this scheduler holds the lock, taking it if it is free.
+        """
+        if self._lock_fd is None:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                return False
+            LOG.info('prefetching as process ' + str(os.getpid()))
+            self._lock_fd = fd
+        return True
+
+    def publish(self, dt):
+        """
+        Fetches, parses and caches the entry of the date. Its page is always
+        revalidated against the APOD site, even if it is cached and not due
+        yet, which pushes back when the entry expires.
+        """
+        utility.cache_json(utility._get_apod_chars(dt, revalidate=True), dt)
+
+    def run_once(self):
+        """
+        Does what is due and returns the number of seconds until it should be
+        called again.
+        """
+        if not self.is_leader():
+            return self.max_interval
+
+        now = eastern_now()
+        day = now.date()
+        if day != self._day:
+            self._day, self._misses = day, 0
+
+        if not utility.cached_json_exists_for(day):
+            try:
+                self.publish(day)
+            except Exception as ex:
+                # most likely not up yet
+                LOG.debug('no entry yet for ' + str(day) + ': ' + str(ex))
+                self._misses += 1
+                return min(self.poll_interval * 2 ** (self._misses - 1), self.max_interval,
+                           max(seconds_until_rollover(now), 1))
+            LOG.info('published the entry of ' + str(day))
+
+        # refresh the recent entries a little before they have to be revalidated
+        margin = min(60, utility.RECENT_TTL / 10)
+        wait = seconds_until_rollover(now)
+        for dt in (day - timedelta(days=1), day):
+            expires = utility._expiry_for(dt)
+            if expires is None or not utility.cached_json_exists_for(dt):
+                continue
+            if expires - time.time() <= margin:
+                try:
+                    self.publish(dt)
+                except Exception as ex:
+                    LOG.error('Could not refresh ' + str(dt) + ': ' + str(ex))
+                    continue
+                expires = utility._expiry_for(dt)
+            wait = min(wait, expires - time.time() - margin)
+        return max(wait, 1)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                wait = self.run_once()
+            except Exception as ex:
+                LOG.error('Prefetch failed: ' + str(ex))
+                wait = self.poll_interval
+            self._stopped.wait(wait)
+
+    def start(self):
+        """
+        Runs the scheduler in a background thread.
+        """
+        self._thread = threading.Thread(target=self.run, name='apod-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _started():
+    scheduler = Scheduler()
+    scheduler.start()
+    return scheduler
+
+
+_scheduler = perprocess.PerProcess(_started)
+
+
+def start():
+    """
+    Starts the scheduler of this process, unless it is already running. Call
+    it in the processes serving requests: a scheduler started before they
+    were forked (e.g. gunicorn --preload) stays behind in the parent.
+    """
+    return _scheduler.get()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prefetch the new APOD entry every day as soon as it is up.')
+    parser.add_argument('--poll-interval', type=float, default=PREFETCH_POLL_INTERVAL,
+                        help='seconds between the first polls for a new page (default: %(default)s)')
+    parser.add_argument('--max-interval', type=float, default=PREFETCH_MAX_INTERVAL,
+                        help='longest wait between two polls, in seconds (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+    scheduler = Scheduler(poll_interval=args.poll_interval, max_interval=args.max_interval)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+Search indexes over the cached APOD entries.
+
+The indexes are kept up to date by utility.cache_json, so they cover exactly
+the entries in the JSON cache; utility.reindex rebuilds them from the cache.
+"""
+
+from array import array
+from datetime import date
+import bisect
+import fcntl
+import logging
+import os
+import random
+import threading
+
+try:
+    import store
+except ImportError:
+    from apod import store
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+LOG = logging.getLogger(__name__)
+
+
+class SearchUnavailable(Exception):
+    """
+    Full-text search is disabled, or this Python's SQLite can't do it.
+    """
+    pass
+
+
+def normalize_keyword(keyword):
+    # keywords are already lowercased by the parser, but not the queries
+    return ' '.join(keyword.lower().split())
+
+
+class KeywordIndex(object):
+    """
+    Maps each keyword to the sorted ordinals of the dates tagged with it, and
+    keeps the ordinals of every indexed (so cached, known-good) date.
+
+    It is persisted as an append-only log with one `<ordinal>\t<keyword>\t...`
+    line per indexed entry; a later line for the same date replaces the earlier
+    one. Writers append under an exclusive lock, and every process catches up
+    with the lines other processes appended before answering a query, so all
+    gunicorn workers share one index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._offset = 0
+        self._postings = {}  # keyword -> array of ordinals
+        self._keywords = {}  # ordinal -> tuple of keywords
+        self._ordinals = array('i')  # every indexed date
+
+    def _refresh(self):
+        # the log was rebuilt (replaced) by another process: start over
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self._fd).st_ino
+        except OSError:
+            replaced = True
+        if replaced:
+            os.close(self._fd)
+            self._open()
+
+        size = os.fstat(self._fd).st_size
+        if size <= self._offset:
+            return
+        tail = os.pread(self._fd, size - self._offset, self._offset)
+        # a line still being written is read on the next refresh
+        end = tail.rfind(b'\n') + 1
+        for line in tail[:end].decode('utf-8').splitlines():
+            fields = line.split('\t')
+            try:
+                ordinal = int(fields[0])
+            except ValueError:
+                LOG.error('Corrupt line in ' + self.path + ': ' + line)
+                continue
+            self._apply(ordinal, tuple(fields[1:]))
+        self._offset += end
+
+    def _apply(self, ordinal, keywords):
+        if ordinal not in self._keywords:
+            bisect.insort(self._ordinals, ordinal)
+        for keyword in self._keywords.get(ordinal, ()):
+            postings = self._postings[keyword]
+            del postings[bisect.bisect_left(postings, ordinal)]
+            if not postings:
+                del self._postings[keyword]
+        self._keywords[ordinal] = keywords
+        for keyword in keywords:
+            bisect.insort(self._postings.setdefault(keyword, array('i')), ordinal)
+
+    @staticmethod
+    def _line(ordinal, keywords):
+        return '\t'.join([str(ordinal)] + list(keywords)) + '\n'
+
+    @staticmethod
+    def _normalized(keywords):
+        return tuple(sorted(set(filter(None, (normalize_keyword(keyword) for keyword in keywords or ())))))
+
+    def add(self, dt, keywords):
+        """
+        Indexes the date under the keywords, in place of what it had before.
+        """
+        self.add_many([(dt, keywords)])
+
+    def add_many(self, items):
+        """
+        Indexes many (date, keywords) pairs with a single write.
+        """
+        with self._lock:
+            self._refresh()
+            lines = []
+            for dt, keywords in items:
+                keywords = self._normalized(keywords)
+                if self._keywords.get(dt.toordinal()) != keywords:
+                    lines.append(self._line(dt.toordinal(), keywords))
+            if not lines:
+                return
+
+            # lockf, not flock: forked workers may share this descriptor
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                os.write(self._fd, ''.join(lines).encode('utf-8'))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            self._refresh()
+
+    def rebuild(self, items):
+        """
+        Replaces the whole index with the (date, keywords) pairs, writing a
+        new, compacted log.
+        """
+        with self._lock:
+            with store.atomic_file(self.path) as file:
+                for dt, keywords in items:
+                    file.write(self._line(dt.toordinal(), self._normalized(keywords)).encode('utf-8'))
+            self._refresh()
+
+    def dates_for(self, keyword, start_dt=None, end_dt=None):
+        """
+        Returns the dates tagged with the keyword, in order, optionally only
+        those from start_dt to end_dt (inclusive).
+        """
+        with self._lock:
+            self._refresh()
+            postings = self._postings.get(normalize_keyword(keyword), ())
+            first = bisect.bisect_left(postings, start_dt.toordinal()) if start_dt else 0
+            last = bisect.bisect_right(postings, end_dt.toordinal()) if end_dt else len(postings)
+            return [date.fromordinal(ordinal) for ordinal in postings[first:last]]
+
+    def sample(self, count):
+        """
+        Returns up to count indexed dates drawn at random, without repeats.
+        """
+        with self._lock:
+            self._refresh()
+            return [date.fromordinal(ordinal) for ordinal in random.sample(self._ordinals,
+                                                                           min(count, len(self._ordinals)))]
+
+
+class FullTextIndex(object):
+    """
+    A SQLite FTS5 index over the title, explanation and copyright of the
+    entries, with the date ordinal as rowid. Each thread (and process) has its
+    own connection; SQLite's own locking serializes the writers.
+    """
+
+    FIELDS = ('title', 'explanation', 'copyright')
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(%s)' % ', '.join(self.FIELDS))
+
+    @staticmethod
+    def available():
+        """
+        Whether this Python's SQLite has FTS5.
+        """
+        if sqlite3 is None:
+            return False
+        try:
+            sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE test USING fts5(text)')
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _connection(self):
+        # connections can't be shared across threads, nor survive a fork
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection.execute('PRAGMA journal_mode=WAL')
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _rows(self, items):
+        for dt, data in items:
+            yield (dt.toordinal(),) + tuple(data.get(field) or '' for field in self.FIELDS)
+
+    def add(self, dt, data):
+        """
+        Indexes the entry of the date, in place of what it had before.
+        """
+        self.add_many([(dt, data)])
+
+    def add_many(self, items):
+        """
+        Indexes many (date, entry) pairs in a single transaction.
+        """
+        rows = list(self._rows(items))
+        with self._connection() as connection:
+            connection.executemany('DELETE FROM entries WHERE rowid = ?', [row[:1] for row in rows])
+            connection.executemany('INSERT INTO entries (rowid, %s) VALUES (?, ?, ?, ?)' % ', '.join(self.FIELDS),
+                                   rows)
+
+    def rebuild(self, items):
+        """
+        Replaces the whole index with the (date, entry) pairs.
+        """
+        with self._connection() as connection:
+            connection.execute('DELETE FROM entries')
+            connection.executemany('INSERT INTO entries (rowid, %s) VALUES (?, ?, ?, ?)' % ', '.join(self.FIELDS),
+                                   self._rows(items))
+            # merged in the same transaction, which releases the write lock
+            connection.execute("INSERT INTO entries (entries) VALUES ('optimize')")
+
+    @staticmethod
+    def _match(text):
+        # every word must appear; quoted so that user input is never parsed
+        # as FTS5 query syntax
+        return ' '.join('"%s"' % word.replace('"', '""') for word in text.split())
+
+    def search(self, text, start_dt=None, end_dt=None, limit=20, offset=0):
+        """
+        Returns the dates of the entries containing every word of the text,
+        best matches first, optionally only those from start_dt to end_dt
+        (inclusive).
+        """
+        match = self._match(text)
+        if not match:
+            return []
+        rows = self._connection().execute(
+            'SELECT rowid FROM entries WHERE entries MATCH ? AND rowid BETWEEN ? AND ? '
+            'ORDER BY rank LIMIT ? OFFSET ?',
+            (match, start_dt.toordinal() if start_dt else 0, end_dt.toordinal() if end_dt else date.max.toordinal(),
+             limit, offset))
+        return [date.fromordinal(ordinal) for ordinal, in rows]
@@ -12,14 +12,27 @@ Dec 1, 2015 (written by Dan Hammer)
 import sys
 sys.path.insert(0, "../lib")
 
-from multiprocessing.dummy import Pool
-
-from datetime import datetime, date
-from flask import request, jsonify, render_template, Flask
+from concurrent.futures import wait
+from datetime import datetime, date, timedelta
+from flask import request, jsonify, render_template, Flask, Response
 from flask_cors import CORS
 from flask_gzip import Gzip
-from utility import parse_apod, cache_json, cached_json_for, cached_json_exists_for
+from utility import parse_apod, cache_json, cached_json_exists_for, cached_json_range, fill_flights, \
+    negative_cached_range, cached_entry_for, cached_etag_for, etag_for, encoded_body_for, response_body, BODY_ENCODINGS, \
+    keyword_dates, fulltext_dates, archived_entries, negative_cached_for, cached_dates_sample
+from archive import FIELDS as ENTRY_FIELDS
+from fetcher import fetcher
+from search import SearchUnavailable
+import metrics
+import scheduler
+from store import FIRST_DATE
+from urllib.parse import urlencode
 import logging
+import json
+import os
+import random
+import time
+import zlib
 
 app = Flask(__name__)
 CORS(app)
@@ -28,11 +41,35 @@ gzip = Gzip(app)
 LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+
+@app.before_request
+def _start_prefetching():
+    # started by the processes serving requests, not at import: with gunicorn
+    # --preload the module is imported by the arbiter, which the workers are
+    # forked from (and which threads don't survive)
+    if scheduler.PREFETCH:
+        scheduler.start()
+
 # this should reflect both this service and the backing 
 # assorted libraries
 SERVICE_VERSION = 'v2'
 APOD_METHOD_NAME = 'apod'
-ALLOWED_APOD_FIELDS = ['date', 'start_date', 'end_date']
+ALLOWED_APOD_FIELDS = ['date', 'start_date', 'end_date', 'keyword', 'count', 'cursor', 'fields']
+SEARCH_METHOD_NAME = 'search'
+ALLOWED_SEARCH_FIELDS = ['q', 'start_date', 'end_date', 'count', 'page']
+# default and maximum number of search results per page
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# maximum number of entries per page of a range
+MAX_PAGE_SIZE = 1000
+# maximum number of random entries per request
+MAX_RANDOM_COUNT = 100
+# seconds a random sample waits for the entries missing from the cache
+RANDOM_FILL_TIMEOUT = float(os.environ.get('APOD_RANDOM_FILL_TIMEOUT', 5))
+# number of days of a range loaded (and fetched) at a time while streaming
+RANGE_CHUNK_SIZE = 100
+# max-age of entries that won't change anymore (past dates)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
 
 
@@ -90,11 +127,12 @@ def _apod_handler(dt, use_default_today_date=False):
         return _abort(500, 'Internal Service Error', usage=False)
 
 
-def _get_json_for_date(input_date):
+def _get_json_for_date(input_date, fields=None):
     """
     This returns the JSON data for a specific date, which must be a string of the form YYYY-MM-DD. If date is None,
     then it defaults to the current date.
     :param input_date:
+    :param fields: the fields to return, None for all of them
     :return:
     """
 
@@ -109,24 +147,187 @@ def _get_json_for_date(input_date):
     dt = datetime.strptime(input_date, '%Y-%m-%d').date()
     _validate_date(dt)
 
-    # get data
+    if fields:
+        return _get_projected_json_for_date(dt, use_default_today_date, fields)
+
+    encoding = _accepted_encoding()
+
+    # answer conditional requests for entries held in memory right away
+    etag, expires = cached_etag_for(dt)
+    if etag and _not_modified(etag):
+        return _cacheable(Response(status=304), etag, expires, encoding)
+
+    # get data, as the final (possibly compressed) response body
     try:
-        data = cached_json_for(dt)
+        body, expires, etag = encoded_body_for(dt, SERVICE_VERSION, encoding)
+    except:
+        data, expires, etag = _filled_entry(dt, use_default_today_date)
+        try:
+            body, expires, etag = encoded_body_for(dt, SERVICE_VERSION, encoding)
+        except KeyError:
+            body = response_body(_serialized(data), SERVICE_VERSION, encoding)
+
+    if _not_modified(etag):
+        return _cacheable(Response(status=304), etag, expires, encoding)
+
+    return _cacheable(Response(body, mimetype='application/json'), etag, expires, encoding)
+
+
+def _get_projected_json_for_date(dt, use_default_today_date, fields):
+    """
+    Like _get_json_for_date, with only the given fields. Such bodies aren't
+    stored, they are built for every request.
+    """
+    try:
+        data, expires, etag = cached_entry_for(dt)
+    except KeyError:
+        data, expires, etag = _filled_entry(dt, use_default_today_date)
+
+    encoding = _accepted_encoding()
+    blob = _serialized(data, fields)
+    etag = etag_for(blob)
+    if _not_modified(etag):
+        return _cacheable(Response(status=304), etag, expires, encoding)
+
+    # compressed here rather than by the Gzip wrapper, which would keep the tag
+    response = Response(response_body(blob, SERVICE_VERSION, encoding), mimetype='application/json')
+    return _cacheable(response, etag, expires, encoding)
+
+
+def _fields(text):
+    """
+    Returns the list of fields of a `fields` parameter (comma separated), None
+    if there is none.
+    """
+    if text is None:
+        return None
+    fields = [field.strip() for field in text.split(',') if field.strip()]
+    for field in fields:
+        if field not in ENTRY_FIELDS:
+            raise ValueError('Unknown field %s, expected some of %s.' % (field, ', '.join(ENTRY_FIELDS)))
+    if not fields:
+        raise ValueError('fields cannot be empty.')
+    return fields
+
+
+def _project(data, fields):
+    return dict((key, value) for key, value in data.items() if key in fields)
+
+
+def _projected(entry, fields):
+    """
+    Returns the serialized entry with only the given fields (all of them if
+    fields is None).
+    """
+    if not entry or not fields:
+        return entry
+    with metrics.SERIALIZE_SECONDS.time(kind='projection'):
+        return json.dumps(_project(json.loads(entry.decode('utf-8')), fields)).encode('utf-8')
+
+
+def _serialized(data, fields=None):
+    with metrics.SERIALIZE_SECONDS.time(kind='entry'):
+        return json.dumps(_project(data, fields) if fields else data).encode('utf-8')
+
+
+def _page_size(count):
+    count = int(count)
+    if count < 1 or count > MAX_PAGE_SIZE:
+        raise ValueError('count must be between 1 and %d.' % MAX_PAGE_SIZE)
+    return count
+
+
+def _link_next(response, **changes):
+    """
+    Adds a Link header pointing to this request with the given parameters
+    changed, as the next page of the response.
+    """
+    args = request.args.to_dict()
+    args.update(changes)
+    response.headers['Link'] = '<%s?%s>; rel="next"' % (request.base_url, urlencode(args))
+    return response
+
+
+def _accepted_encoding():
+    """
+    Returns the preferred content encoding the client accepts that bodies are
+    stored with, or None.
+    """
+    for encoding in BODY_ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def _fill_cache(dt, use_default_today_date):
+    # resolves the flight with the entry's data, like the fetcher's downloads
+    # sharing the same flights
+    try:
+        # the cache may have been filled while we were waiting for our turn
+        return cached_entry_for(dt)[0]
     except:
         data = _apod_handler(dt, use_default_today_date)
         cache_json(data, dt)
+        return data
 
-    data['service_version'] = SERVICE_VERSION
 
-    return data
+def _filled_entry(dt, use_default_today_date):
+    """
+    Fills the cache for the date and returns (data, expires, etag) like
+    cached_entry_for. Concurrent misses on the same date, from single dates
+    or ranges, wait for a single fetch.
+    """
+    data = fill_flights.do((dt, use_default_today_date), _fill_cache, dt, use_default_today_date)
+    try:
+        return cached_entry_for(dt)
+    except KeyError:
+        # not kept in memory (e.g. served in place of today's date)
+        return dict(data), time.time(), etag_for(json.dumps(data).encode('utf-8'))
+
 
+def _entity_tag(etag, encoding=None):
+    # responses carry the service version too, and a strong tag has to differ
+    # between the content codings of a body
+    tag = SERVICE_VERSION + '-' + etag
+    return tag + '-' + encoding if encoding else tag
 
-def _get_json_for_date_range(start_date, end_date):
+
+def _not_modified(etag):
+    """
+    Whether the request's If-None-Match matches the entry, in any encoding: a
+    client may have cached it before asking for another one.
+    """
+    return any(request.if_none_match.contains(_entity_tag(etag, encoding)) for encoding in [None] + BODY_ENCODINGS)
+
+
+def _cacheable(response, etag, expires, encoding=None):
+    """
+    Adds the ETag and Cache-Control headers of an entry to the response, whose
+    body is in the given content encoding. Entries of past dates never
+    change, recent ones only until `expires`.
+    """
+    if encoding and response.status_code != 304:
+        response.headers['Content-Encoding'] = encoding
+    response.set_etag(_entity_tag(etag, encoding))
+    if expires is None:
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=%d' % max(0, int(expires - time.time()))
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def _get_json_for_date_range(start_date, end_date, count=None, cursor=None, fields=None):
     """
     This returns the JSON data for a range of dates, specified by start_date and end_date, which must be strings of the
-    form YYYY-MM-DD. If end_date is None then it defaults to the current date.
+    form YYYY-MM-DD. If end_date is None then it defaults to the current date. With a count, only the first count
+    entries from the cursor (a date of the range, start_date by default) are returned, along with a Link header to the
+    next page.
     :param start_date:
     :param end_date:
+    :param count: number of entries per page, None for the whole range
+    :param cursor: the first date of the page, as given by the Link header of the previous page
+    :param fields: the fields to return, None for all of them
     :return:
     """
     # validate input date
@@ -148,39 +349,252 @@ def _get_json_for_date_range(start_date, end_date):
 
     if start_ordinal > end_ordinal:
         raise ValueError('start_date cannot be after end_date')
+    metrics.RANGE_DAYS.observe(end_ordinal - start_ordinal + 1)
+
+    if cursor:
+        cursor_dt = datetime.strptime(cursor, '%Y-%m-%d').date()
+        if cursor_dt < start_dt or cursor_dt > end_dt:
+            raise ValueError('cursor is out of the date range.')
+        start_ordinal = cursor_dt.toordinal()
+
+    if not count:
+        entries = _iter_range_entries(start_ordinal, end_ordinal, today_ordinal, fields)
+        return _streamed_json_array(entry for dt, entry in entries)
 
-    all_data = []
+    count = _page_size(count)
+    page = list(_iter_range_entries(start_ordinal, end_ordinal, today_ordinal, fields, limit=count))
 
-    while start_ordinal <= end_ordinal:
-        # get data
-        dt = date.fromordinal(start_ordinal)
-        touple = (dt, start_ordinal == today_ordinal)
-        all_data.append(touple)
-        start_ordinal += 1
+    response = _streamed_json_array(entry for dt, entry in page)
+    if len(page) == count and page[-1][0] < end_dt:
+        _link_next(response, cursor=(page[-1][0] + timedelta(days=1)).isoformat())
+    return response
 
 
-    pool = Pool(min(100, len(all_data)))  # max 100 threads
-    apods = pool.map(threaded_download, all_data)
-    pool.close()
-    pool.join()
+def _get_json_for_random(count, fields=None):
+    """
+    This returns count entries of dates drawn uniformly at random, known unusable dates excepted. The entries missing
+    from the cache are downloaded concurrently, for at most RANDOM_FILL_TIMEOUT seconds; those that can't be had by
+    then are replaced with entries of random cached (known-good) dates.
+    :param count:
+    :param fields: the fields to return, None for all of them
+    :return:
+    """
+    count = int(count)
+    if count < 1 or count > MAX_RANDOM_COUNT:
+        raise ValueError('count must be between 1 and %d.' % MAX_RANDOM_COUNT)
 
-    apods = [apod for apod in apods if apod]  # remove None's
-    return jsonify(apods)
+    today_ordinal = datetime.today().date().toordinal()
+    population = range(FIRST_DATE.toordinal(), today_ordinal + 1)
+    dates = []
+    # a few spare draws make up for the unusable dates
+    for ordinal in random.sample(population, min(len(population), 2 * count)):
+        if not negative_cached_for(date.fromordinal(ordinal)):
+            dates.append(date.fromordinal(ordinal))
+            if len(dates) == count:
+                break
+
+    entries = _cached_entries(dates, fields)
+    futures = dict((dt, fetcher().submit(dt, dt.toordinal() == today_ordinal))
+                   for dt, entry in zip(dates, entries) if entry is None)
+    if futures:
+        # downloads still running go on filling the cache for the next time
+        wait(list(futures.values()), timeout=RANDOM_FILL_TIMEOUT)
+        for idx, dt in enumerate(dates):
+            future = futures.get(dt)
+            if future and future.done() and not future.cancelled() and future.result():
+                entries[idx] = _serialized(future.result(), fields)
+
+    entries = [entry for entry in entries if entry]
+    if len(entries) < count:
+        spares = [dt for dt in cached_dates_sample(count + len(dates)) if dt not in dates][:count - len(entries)]
+        entries += [entry for entry in _cached_entries(spares, fields) if entry]
+
+    response = _streamed_json_array(iter(entries))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
-def threaded_download(touple):
-    requested_date = touple[0]
-    use_default_today_date = touple[1]
-    
+def _get_json_for_keyword(keyword, start_date, end_date, fields=None):
+    """
+    This returns the JSON data for the dates tagged with the keyword (case insensitive), optionally only those from
+    start_date to end_date (strings of the form YYYY-MM-DD). Only the entries already cached are searched.
+    :param keyword:
+    :param start_date:
+    :param end_date:
+    :param fields: the fields to return, None for all of them
+    :return:
+    """
+    start_dt, end_dt = _date_filter(start_date, end_date)
+    dates = keyword_dates(keyword, start_dt, end_dt)
+    entries = _iter_entries(dates, datetime.today().date().toordinal(), fields)
+    return _streamed_json_array(entry for dt, entry in entries)
+
+
+def _get_json_for_search(text, start_date, end_date, count, page):
+    """
+    This returns one page of the JSON data for the entries whose title, explanation or copyright contain every word
+    of the text, best matches first, optionally only those from start_date to end_date. A Link header points to the
+    next page, if there is one. Only the entries already cached are searched.
+    :param text:
+    :param start_date:
+    :param end_date:
+    :param count: number of entries per page
+    :param page: page number, starting from 1
+    :return:
+    """
+    start_dt, end_dt = _date_filter(start_date, end_date)
+
+    count = int(count) if count else SEARCH_PAGE_SIZE
+    if count < 1 or count > MAX_SEARCH_PAGE_SIZE:
+        raise ValueError('count must be between 1 and %d.' % MAX_SEARCH_PAGE_SIZE)
+    page = int(page) if page else 1
+    if page < 1:
+        raise ValueError('page must be at least 1.')
+
+    # one more than asked for tells whether there is a next page
+    dates = fulltext_dates(text, start_dt, end_dt, count + 1, (page - 1) * count)
+
+    entries = _iter_entries(dates[:count], datetime.today().date().toordinal())
+    response = _streamed_json_array(entry for dt, entry in entries)
+    if len(dates) > count:
+        _link_next(response, page=page + 1)
+    return response
+
+
+def _date_filter(start_date, end_date):
+    """
+    Returns the (start, end) dates of an optional date filter, None where
+    not given.
+    """
+    start_dt = end_dt = None
+    if start_date:
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
+        _validate_date(start_dt)
+    if end_date:
+        end_dt = datetime.strptime(end_date, '%Y-%m-%d').date()
+        _validate_date(end_dt)
+    if start_dt and end_dt and start_dt > end_dt:
+        raise ValueError('start_date cannot be after end_date')
+    return start_dt, end_dt
+
+
+def _iter_range_entries(start_ordinal, end_ordinal, today_ordinal, fields=None, limit=None):
+    """
+    Yields (date, serialized JSON entry) from start_ordinal to end_ordinal in
+    date order, at most `limit` of them if given. The range is walked
+    RANGE_CHUNK_SIZE days at a time so that only one chunk is held in memory;
+    dates missing from the cache are downloaded concurrently by the process
+    wide fetcher, unless they are known not to have a usable entry. With a
+    limit, chunks are no longer than the number of entries still needed, so
+    that no more days are downloaded than can be returned.
+    """
+    chunk_start = start_ordinal
+    while chunk_start <= end_ordinal and (limit is None or limit > 0):
+        chunk_end = min(chunk_start + min(RANGE_CHUNK_SIZE, limit or RANGE_CHUNK_SIZE) - 1, end_ordinal)
+
+        dates = [date.fromordinal(ordinal) for ordinal in range(chunk_start, chunk_end + 1)]
+        entries = _cached_entries(dates, fields, consecutive=True)
+
+        if None in entries:
+            negatives = negative_cached_range(date.fromordinal(chunk_start), date.fromordinal(chunk_end))
+            entries = [b'' if negative else entry for entry, negative in zip(entries, negatives)]
+
+        for item in _filled(dates, entries, today_ordinal, fields):
+            yield item
+            if limit is not None:
+                limit -= 1
+        chunk_start = chunk_end + 1
+
+
+def _iter_entries(dates, today_ordinal, fields=None):
+    """
+    Yields (date, serialized JSON entry) for the given dates, in the given
+    order, RANGE_CHUNK_SIZE dates at a time. Like _iter_range_entries,
+    downloads the ones missing from the cache.
+    """
+    for idx in range(0, len(dates), RANGE_CHUNK_SIZE):
+        chunk = dates[idx:idx + RANGE_CHUNK_SIZE]
+        yield from _filled(chunk, _cached_entries(chunk, fields), today_ordinal, fields)
+
+
+def _cached_entries(dates, fields=None, consecutive=False):
+    """
+    Returns the serialized JSON entries of the dates with only the given
+    fields, None for dates not cached. Projected entries are taken from the
+    compact archive when it has them, which spares loading whole entries.
+    """
+    archived = archived_entries(dates, fields) if fields else {}
+    if consecutive and not archived:
+        # one slice of the cache index gives us every already serialized entry
+        entries = cached_json_range(dates[0], dates[-1])
+    else:
+        entries = [None if dt in archived else cached_json_range(dt, dt)[0] for dt in dates]
+    return [_serialized(archived[dt]) if dt in archived else _projected(entry, fields)
+            for dt, entry in zip(dates, entries)]
+
+
+def _filled(dates, entries, today_ordinal, fields=None):
+    """
+    Yields (date, entry) for the dates, downloading the missing entries (None)
+    concurrently and skipping the known unusable ones (empty).
+    """
+    all_data = [(dt, dt.toordinal() == today_ordinal) for dt, entry in zip(dates, entries) if entry is None]
+    apods = fetcher().map(all_data) if all_data else (apod for apod in ())
+
     try:
-        return cached_json_for(requested_date)
-    except:    
-        try:
-            data = _apod_handler(requested_date, use_default_today_date)
-            cache_json(data, requested_date)
-            return data
-        except:
-            return None
+        for dt, entry in zip(dates, entries):
+            if entry is None:
+                apod = next(apods)
+                if not apod:
+                    continue  # skip None's
+                entry = _serialized(apod, fields)
+            elif not entry:
+                continue  # known unusable date
+            yield dt, entry
+    finally:
+        apods.close()
+
+
+def _streamed_json_array(entries):
+    """
+    Returns a streamed response writing `entries` (serialized JSON objects)
+    as a JSON array. The body is gzipped on the fly when the client accepts
+    it; the response is marked as passthrough so that the Gzip wrapper does
+    not buffer the whole stream to compress it a second time.
+    """
+
+    def generate():
+        yield b'['
+        for idx, entry in enumerate(entries):
+            if idx:
+                yield b','
+            yield entry
+        yield b']'
+
+    body = generate()
+    response = Response(mimetype='application/json')
+
+    if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+        body = _gzipped(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+
+    response.response = body
+    response.direct_passthrough = True
+    return response
+
+
+def _gzipped(chunks, flush_every=64):
+    compressor = zlib.compressobj(gzip.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for idx, chunk in enumerate(chunks):
+        data = compressor.compress(chunk)
+        if idx % flush_every == 0:
+            # push what we have to the client instead of waiting for zlib's buffer to fill
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
 
 #
 # Endpoints
@@ -209,12 +623,25 @@ def apod():
         input_date = args.get('date')
         start_date = args.get('start_date')
         end_date = args.get('end_date')
-
-        if not start_date and not end_date:
-            return _get_json_for_date(input_date)
+        keyword = args.get('keyword')
+        count = args.get('count')
+        cursor = args.get('cursor')
+        fields = _fields(args.get('fields'))
+
+        if keyword is not None:
+            if input_date or count or cursor or not keyword.strip():
+                return _abort(400, 'Bad Request: invalid field combination passed.')
+            return _get_json_for_keyword(keyword, start_date, end_date, fields)
+
+        elif not start_date and not end_date:
+            if cursor or (count and input_date):
+                return _abort(400, 'Bad Request: invalid field combination passed.')
+            elif count:
+                return _get_json_for_random(count, fields)
+            return _get_json_for_date(input_date, fields)
 
         elif not input_date and start_date:
-            return _get_json_for_date_range(start_date, end_date)
+            return _get_json_for_date_range(start_date, end_date, count, cursor, fields)
 
         else:
             return _abort(400, 'Bad Request: invalid field combination passed.')
@@ -232,6 +659,43 @@ def apod():
             return _abort(500, 'Internal Service Error', usage=False)
 
 
+@app.route('/' + SERVICE_VERSION + '/' + APOD_METHOD_NAME + '/' + SEARCH_METHOD_NAME, methods=['GET'])
+def apod_search():
+    LOG.info('search path called')
+    try:
+
+        args = request.args
+
+        for key in args:
+            if key not in ALLOWED_SEARCH_FIELDS:
+                return _abort(400, 'Bad Request: incorrect field passed. Allowed request fields for '
+                              + SEARCH_METHOD_NAME + ' method are ' + ', '.join(ALLOWED_SEARCH_FIELDS), usage=False)
+
+        text = args.get('q', '')
+        if not text.strip():
+            return _abort(400, 'Bad Request: q is required.', usage=False)
+
+        return _get_json_for_search(text, args.get('start_date'), args.get('end_date'), args.get('count'),
+                                    args.get('page'))
+
+    except ValueError as ve:
+        return _abort(400, str(ve), False)
+
+    except SearchUnavailable as su:
+        return _abort(501, str(su), False)
+
+    except Exception as ex:
+        LOG.error('Service Exception. Msg: ' + str(type(ex)))
+        return _abort(500, 'Internal Service Error', usage=False)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.METRICS:
+        return _abort(404, 'Sorry, Nothing at this URL.', usage=False)
+    return Response(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     """
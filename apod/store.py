@@ -0,0 +1,286 @@
+"""
+Storage backends for the APOD caches.
+
+Every backend maps a date to an opaque blob of bytes. The 'files' backend is
+the historical one-file-per-date layout, the 'packed' backend keeps a single
+append-only data file plus a fixed-width index keyed by date ordinal.
+
+Writes are atomic and safe across processes (e.g. gunicorn workers sharing
+one cache): a reader sees either the previous blob or the new one, never a
+partially written one.
+"""
+
+from contextlib import contextmanager
+from datetime import date
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+# first APOD image date; index slot 0 of the packed store
+FIRST_DATE = date(1995, 6, 16)
+FIRST_ORDINAL = FIRST_DATE.toordinal()
+
+
+def _umask():
+    # the umask can only be read by setting it
+    umask = os.umask(0o22)
+    os.umask(umask)
+    return umask
+
+
+# mode of the files we write, as open() would create them; mkstemp's 0600
+# would keep other users (e.g. the one filling the cache) from reading them
+FILE_MODE = 0o666 & ~_umask()
+
+
+@contextmanager
+def atomic_file(path, mode='wb'):
+    """
+    Yields a file object writing to a temporary file next to `path`, which is
+    renamed over `path` (atomically) once the block is done.
+    """
+    folder = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class FileStore(object):
+    """
+    One file per date, named by `filename_for(date)`, in `folder`.
+    """
+
+    def __init__(self, folder, filename_for):
+        self.folder = folder
+        self.filename_for = filename_for
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def path_for(self, dt):
+        return os.path.join(self.folder, self.filename_for(dt))
+
+    def get(self, dt):
+        try:
+            with open(self.path_for(dt), 'rb') as file:
+                return file.read()
+        except (IOError, OSError):
+            raise KeyError(dt)
+
+    def put(self, dt, blob):
+        with atomic_file(self.path_for(dt)) as file:
+            file.write(blob)
+
+    def put_many(self, items):
+        for dt, blob in items:
+            self.put(dt, blob)
+
+    def delete(self, dt):
+        try:
+            os.remove(self.path_for(dt))
+        except OSError:
+            pass
+
+    def exists(self, dt):
+        return os.path.exists(self.path_for(dt))
+
+    def get_range(self, start_dt, end_dt):
+        """
+        Returns a list with one entry per date from start_dt to end_dt
+        (inclusive), None where nothing is stored.
+        """
+        blobs = []
+        for ordinal in range(start_dt.toordinal(), end_dt.toordinal() + 1):
+            try:
+                blobs.append(self.get(date.fromordinal(ordinal)))
+            except KeyError:
+                blobs.append(None)
+        return blobs
+
+
+class PackedStore(object):
+    """
+    An append-only data file (`<name>.pack`) and an index (`<name>.idx`) of
+    fixed-width (offset, length, crc32) slots, one per day since FIRST_DATE.
+    Reads go through an mmap of the data file, so a range lookup is one read
+    of a contiguous index slice and no open() per date.
+
+    Writers take an exclusive (POSIX record) lock on the data file, append the
+    blob and only then point the index slot at it. The checksum catches torn
+    or otherwise corrupt records, which are reported as missing.
+    """
+
+    SLOT = struct.Struct('<QII')
+
+    def __init__(self, folder, name):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.data_path = os.path.join(folder, name + '.pack')
+        self.index_path = os.path.join(folder, name + '.idx')
+        self._data_fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock = threading.Lock()
+        self._map = None
+        self._map_size = 0
+
+    def _slot_for(self, dt):
+        slot = dt.toordinal() - FIRST_ORDINAL
+        if slot < 0:
+            raise KeyError(dt)
+        return slot
+
+    def _view(self, end):
+        # (re)map the data file when a record lies past the current mapping
+        if end > self._map_size:
+            with self._lock:
+                if end > self._map_size:
+                    size = os.fstat(self._data_fd).st_size
+                    if end > size:
+                        raise KeyError(end)
+                    # readers may still hold the old map; let it be collected
+                    self._map = mmap.mmap(self._data_fd, size, access=mmap.ACCESS_READ)
+                    self._map_size = size
+        return self._map
+
+    def _read(self, offset, length, crc):
+        try:
+            blob = self._view(offset + length)[offset:offset + length]
+        except KeyError:
+            blob = None
+        if blob is None or zlib.crc32(blob) != crc:
+            LOG.error('Corrupt entry in ' + self.data_path + ' at offset ' + str(offset))
+            return None
+        return blob
+
+    def get(self, dt):
+        raw = os.pread(self._index_fd, self.SLOT.size, self._slot_for(dt) * self.SLOT.size)
+        if len(raw) < self.SLOT.size:
+            raise KeyError(dt)
+        offset, length, crc = self.SLOT.unpack(raw)
+        blob = self._read(offset, length, crc) if length else None
+        if blob is None:
+            raise KeyError(dt)
+        return blob
+
+    def put(self, dt, blob):
+        self.put_many([(dt, blob)])
+
+    def put_many(self, items):
+        with self._lock:
+            # other processes append to the same files; unlike flock, lockf
+            # also keeps apart workers forked with this descriptor open
+            # (gunicorn --preload)
+            fcntl.lockf(self._data_fd, fcntl.LOCK_EX)
+            try:
+                for dt, blob in items:
+                    slot = self._slot_for(dt)
+                    offset = os.lseek(self._data_fd, 0, os.SEEK_END)
+                    os.write(self._data_fd, blob)
+                    os.pwrite(self._index_fd, self.SLOT.pack(offset, len(blob), zlib.crc32(blob)),
+                              slot * self.SLOT.size)
+            finally:
+                fcntl.lockf(self._data_fd, fcntl.LOCK_UN)
+
+    def delete(self, dt):
+        try:
+            slot = self._slot_for(dt)
+        except KeyError:
+            return
+        with self._lock:
+            fcntl.lockf(self._data_fd, fcntl.LOCK_EX)
+            try:
+                os.pwrite(self._index_fd, self.SLOT.pack(0, 0, 0), slot * self.SLOT.size)
+            finally:
+                fcntl.lockf(self._data_fd, fcntl.LOCK_UN)
+
+    def compact(self):
+        """
+        Rewrites the data file with only the blobs the index points to,
+        dropping those replaced or deleted since (every put appends). Returns
+        the number of bytes freed.
+
+        No other process may have the store open meanwhile (stop the service,
+        see apod-prewarm --compact): it would go on appending to the old data
+        file.
+        """
+        with self._lock:
+            fcntl.lockf(self._data_fd, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(self._data_fd).st_size
+                raw = os.pread(self._index_fd, os.fstat(self._index_fd).st_size, 0)
+                index = bytearray()
+                offset = 0
+                with atomic_file(self.data_path) as data:
+                    for old_offset, length, crc in self.SLOT.iter_unpack(raw):
+                        blob = os.pread(self._data_fd, length, old_offset) if length else b''
+                        if not length or zlib.crc32(blob) != crc:
+                            index += self.SLOT.pack(0, 0, 0)
+                            continue
+                        data.write(blob)
+                        index += self.SLOT.pack(offset, length, crc)
+                        offset += length
+                # a crash in between leaves slots pointing at the wrong
+                # blobs, which their checksums report as missing
+                with atomic_file(self.index_path) as index_file:
+                    index_file.write(index)
+            finally:
+                fcntl.lockf(self._data_fd, fcntl.LOCK_UN)
+
+            os.close(self._data_fd)
+            os.close(self._index_fd)
+            self._data_fd = os.open(self.data_path, os.O_RDWR | os.O_APPEND)
+            self._index_fd = os.open(self.index_path, os.O_RDWR)
+            self._map = None
+            self._map_size = 0
+        return size - offset
+
+    def exists(self, dt):
+        try:
+            self.get(dt)
+        except KeyError:
+            return False
+        return True
+
+    def get_range(self, start_dt, end_dt):
+        """
+        Returns a list with one entry per date from start_dt to end_dt
+        (inclusive), None where nothing is stored.
+        """
+        first = max(start_dt.toordinal() - FIRST_ORDINAL, 0)
+        count = end_dt.toordinal() - FIRST_ORDINAL - first + 1
+        if count <= 0:
+            return [None] * (end_dt.toordinal() - start_dt.toordinal() + 1)
+        raw = os.pread(self._index_fd, count * self.SLOT.size, first * self.SLOT.size)
+
+        blobs = [None] * (first - (start_dt.toordinal() - FIRST_ORDINAL))
+        for offset, length, crc in self.SLOT.iter_unpack(raw):
+            blobs.append(self._read(offset, length, crc) if length else None)
+        blobs.extend([None] * (end_dt.toordinal() - start_dt.toordinal() + 1 - len(blobs)))
+        return blobs
+
+
+BACKENDS = ('files', 'packed')
+
+
+def open_store(backend, folder, name, filename_for):
+    """
+    Returns the store for `name` using the configured backend.
+    """
+    if backend == 'files':
+        return FileStore(folder, filename_for)
+    elif backend == 'packed':
+        return PackedStore(folder, name)
+    else:
+        raise ValueError('Unknown cache backend %s, expected one of %s' % (backend, ', '.join(BACKENDS)))
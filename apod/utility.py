@@ -6,13 +6,47 @@ Created on Mar 24, 2017
 @author=bathomas @email=brian.a.thomas@nasa.gov
 """
 
-from bs4 import BeautifulSoup, Comment
-from datetime import timedelta
+from bs4 import BeautifulSoup, Comment, Tag
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError
+from datetime import datetime, timedelta
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+import zlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import json
 import os
-import re
+
+try:
+    import archive
+    import media
+    import metrics
+    import perprocess
+    import search
+    import store
+except ImportError:
+    from apod import archive
+    from apod import media
+    from apod import metrics
+    from apod import perprocess
+    from apod import search
+    from apod import store
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARN)
@@ -21,66 +55,852 @@ logging.basicConfig(level=logging.WARN)
 BASE = 'https://apod.nasa.gov/apod/'
 
 
-CACHE_FOLDER_HTML = "cache/html"
-CACHE_FOLDER_JSON = "cache/json"
+# upstream HTTP connection pool (shared by all threads of a process)
+UPSTREAM_POOL_SIZE = int(os.environ.get('APOD_UPSTREAM_POOL_SIZE', 100))
+UPSTREAM_RETRIES = int(os.environ.get('APOD_UPSTREAM_RETRIES', 3))
+UPSTREAM_BACKOFF = float(os.environ.get('APOD_UPSTREAM_BACKOFF', 0.5))
+# (connect, read) timeouts in seconds
+UPSTREAM_TIMEOUT = (float(os.environ.get('APOD_UPSTREAM_CONNECT_TIMEOUT', 5)),
+                    float(os.environ.get('APOD_UPSTREAM_READ_TIMEOUT', 30)))
+
+# BeautifulSoup tree builder used to parse APOD pages, see PARSER_BACKENDS
+HTML_PARSER = os.environ.get('APOD_HTML_PARSER', 'html.parser')
+
+CACHE_FOLDER = os.environ.get('APOD_CACHE_FOLDER', 'cache')
+CACHE_FOLDER_HTML = os.path.join(CACHE_FOLDER, 'html')
+CACHE_FOLDER_JSON = os.path.join(CACHE_FOLDER, 'json')
+CACHE_FOLDER_NEGATIVE = os.path.join(CACHE_FOLDER, 'negative')
+CACHE_FOLDER_META = os.path.join(CACHE_FOLDER, 'meta')
+CACHE_FOLDER_THUMBS = os.path.join(CACHE_FOLDER, 'thumbs')
+CACHE_FOLDER_SEARCH = os.path.join(CACHE_FOLDER, 'search')
+
+# seconds to wait for a video thumbnail (Vimeo API) before going without
+THUMBNAIL_TIMEOUT = float(os.environ.get('APOD_THUMBNAIL_TIMEOUT', 5))
+
+# seconds today's (and yesterday's) entries are served before being
+# revalidated against the APOD site; older entries never change
+RECENT_TTL = int(os.environ.get('APOD_RECENT_TTL', 600))
+# seconds the day before's entry is served for a date whose page isn't up yet
+FALLBACK_TTL = int(os.environ.get('APOD_FALLBACK_TTL', 60))
+
+# content encodings response bodies are stored with, by preference
+BODY_ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+# full-text search over the cached entries (needs SQLite with FTS5), 0 to disable
+FULLTEXT_SEARCH = bool(int(os.environ.get('APOD_FULLTEXT_SEARCH', 1)))
+
+# compact archive (see archive.py, built with apod-prewarm --archive) to load
+ARCHIVE_PATH = os.environ.get('APOD_ARCHIVE')
+
+# seconds a date known to have no usable entry is not fetched again
+NEGATIVE_CACHE_TTL = int(os.environ.get('APOD_NEGATIVE_CACHE_TTL', 7 * 24 * 3600))
+
+# 'files' (one file per date) or 'packed' (single append-only file + index)
+CACHE_BACKEND = os.environ.get('APOD_CACHE_BACKEND', 'files')
+
+# number of parsed JSON entries kept in memory (per process)
+JSON_MEMORY_CACHE_SIZE = int(os.environ.get('APOD_JSON_MEMORY_CACHE_SIZE', 2048))
+
+
+class LRUCache(object):
+    """
+    A small thread-safe, size-bounded least-recently-used mapping. Used to
+    keep hot entries (typically today's date) out of the file cache path.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def peek(self, key):
+        """
+        Returns the value of key without counting a hit or a miss.
+        """
+        with self._lock:
+            return self._data[key]
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+
+_json_memory_cache = LRUCache(JSON_MEMORY_CACHE_SIZE)
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent work on the same key into one call. The first caller
+    to claim a key (the leader) does the work and resolves it; everyone who
+    claims the key meanwhile waits on the same future instead of repeating it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def claim(self, key):
+        """
+        Returns (future, leader). Only the leader must call resolve().
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future, False
+            future = self._futures[key] = Future()
+            return future, True
+
+    def resolve(self, key, result=None, error=None):
+        with self._lock:
+            future = self._futures.pop(key)
+        if isinstance(error, (asyncio.CancelledError, CancelledError)):
+            # the leader gave up, which says nothing about the work: waiters
+            # see a cancelled future and claim the key again
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args):
+        """
+        Returns func(*args), calling it only if no call for key is in flight.
+        """
+        while True:
+            future, leader = self.claim(key)
+            if leader:
+                break
+            try:
+                return future.result()
+            except CancelledError:
+                continue
+
+        try:
+            result = func(*args)
+        except BaseException as ex:
+            self.resolve(key, error=ex)
+            raise
+        self.resolve(key, result)
+        return result
+
+
+# in-flight cache fills, keyed by (date, use_default_today_date) and resolved
+# with the data of the entry, whoever (a request or the fetcher) fills it
+fill_flights = SingleFlight()
+
+
+def json_cache_stats():
+    """
+    Returns the hit/miss counters of the in-memory JSON cache.
+    """
+    return _json_memory_cache.stats()
+
+
+def _json_filename_for(date):
+    return f"{date}.json"
+
+def _html_filename_for(date):
+    date_str = date.strftime('%y%m%d')
+    return f"ap{date_str}.html"
+
+
+def _body_filename_for(encoding):
+    suffix = {'gzip': 'gz', 'br': 'br'}[encoding]
+    return lambda date: f"{date}.json.{suffix}"
+
+
+def _open_store(folder, name, filename_for):
+    if CACHE_BACKEND == 'packed':
+        folder = CACHE_FOLDER
+    return store.open_store(CACHE_BACKEND, folder, name, filename_for)
+
+
+_json_store = _open_store(CACHE_FOLDER_JSON, 'json', _json_filename_for)
+_html_store = _open_store(CACHE_FOLDER_HTML, 'html', _html_filename_for)
+_negative_store = _open_store(CACHE_FOLDER_NEGATIVE, 'negative', _json_filename_for)
+# compressed response bodies, by content encoding
+_body_stores = dict((encoding, _open_store(os.path.join(CACHE_FOLDER, encoding), encoding, _body_filename_for(encoding)))
+                    for encoding in BODY_ENCODINGS)
+# freshness of recent dates: {'checked': time, 'etag': ..., 'last_modified': ...}
+_meta_store = _open_store(CACHE_FOLDER_META, 'meta', _json_filename_for)
+
+# the dates of the cached entries and their keywords, kept up to date by cache_json
+keyword_index = search.KeywordIndex(os.path.join(CACHE_FOLDER_SEARCH, 'keywords.log'))
+# full-text index of the cached entries, None when disabled or unavailable
+fulltext_index = None
+if FULLTEXT_SEARCH and search.FullTextIndex.available():
+    fulltext_index = search.FullTextIndex(os.path.join(CACHE_FOLDER_SEARCH, 'fulltext.sqlite'))
 
-if not os.path.exists(CACHE_FOLDER_JSON):
-    os.makedirs(CACHE_FOLDER_JSON)
 
-if not os.path.exists(CACHE_FOLDER_HTML):
-    os.makedirs(CACHE_FOLDER_HTML)
+def _is_recent(dt):
+    """
+    Whether the APOD page of the date may still appear or change (today and
+    yesterday, as the APOD site runs on US Eastern time).
+    """
+    return dt.toordinal() >= datetime.today().toordinal() - 1
+
+
+# Freshness
+
+def _meta_for(dt):
+    try:
+        return json.loads(_meta_store.get(dt).decode('utf-8'))
+    except (KeyError, ValueError):
+        return None
+
+
+def _expiry_for(dt):
+    """
+    Returns when the cached entry of the date has to be revalidated, None if
+    it never has to (the date is past and its page won't change anymore).
+    """
+    if not _is_recent(dt):
+        return None
+    meta = _meta_for(dt)
+    return meta['checked'] + RECENT_TTL if meta else 0
+
+
+def _is_fallback(data, date):
+    """
+    Whether `data` is the entry of another date, served for `date` because
+    its page wasn't up yet (see parse_apod).
+    """
+    return data['date'] != date.strftime('%Y-%m-%d')
+
 
 # JSON Caching
 
+def etag_for(blob):
+    """
+    Returns the (strong) entity tag of a serialized entry.
+    """
+    return hashlib.sha1(blob).hexdigest()
+
+
+class _Entry(object):
+    """
+    A cached entry as kept in memory: the data, its serialized form, when it
+    is due for revalidation (None: never) and its entity tag, along with the
+    response bodies built from it so far.
+    """
+    __slots__ = ('data', 'blob', 'expires', 'etag', 'bodies')
+
+    def __init__(self, data, blob, expires):
+        self.data = data
+        self.blob = blob
+        self.expires = expires
+        self.etag = etag_for(blob)
+        self.bodies = {}
+
+    def is_fresh(self):
+        return self.expires is None or time.time() < self.expires
+
+
+@metrics.CACHE_SECONDS.timed(operation='write')
 def cache_json(data, date):
-    with open(f"{CACHE_FOLDER_JSON}/{date}.json", "w") as file:
-        json.dump(data, file)
+    blob = json.dumps(data).encode('utf-8')
+
+    if _is_fallback(data, date):
+        # never store the day before's entry under this date: keep it in
+        # memory for a little while and cache it under its own date instead
+        _json_memory_cache.put(date, _Entry(dict(data), blob, time.time() + FALLBACK_TTL))
+        date = datetime.strptime(data['date'], '%Y-%m-%d').date()
+
+    # revalidated entries mostly come back unchanged; don't rewrite them
+    # (with the packed backend, every write grows the data file)
+    try:
+        unchanged = _json_store.get(date) == blob
+    except KeyError:
+        unchanged = False
+
+    _json_memory_cache.put(date, _Entry(dict(data), blob, _expiry_for(date)))
+    if unchanged:
+        return
+    _json_store.put(date, blob)
+    _index([(date, data)])
+
+@metrics.CACHE_SECONDS.timed(operation='write')
+def cache_json_many(items):
+    """
+    Caches many (data, date) pairs with a single store write.
+    """
+    items = [(data, date, json.dumps(data).encode('utf-8')) for data, date in items]
+    _json_store.put_many([(date, blob) for data, date, blob in items])
+    for data, date, blob in items:
+        _json_memory_cache.put(date, _Entry(dict(data), blob, _expiry_for(date)))
+    _index([(date, data) for data, date, blob in items])
+
+def _index(items):
+    """
+    Adds the (date, data) pairs to the search indexes. Failures (e.g. a busy
+    database or a full disk) are logged only: the entries are cached by then,
+    and reindex() brings the indexes up to date again.
+    """
+    try:
+        keyword_index.add_many([(date, data.get('keywords')) for date, data in items])
+    except Exception as ex:
+        LOG.error('Could not update the keyword index: ' + str(ex))
+    if fulltext_index is not None:
+        try:
+            fulltext_index.add_many(items)
+        except Exception as ex:
+            LOG.error('Could not update the full-text index: ' + str(ex))
+
+def _completed(date, entry):
+    """
+    Returns the entry, with its video thumbnail if it was cached without it
+    and it has been found since (then the cached entry is replaced too).
+    """
+    if entry.data.get('thumbnail_url', '') is not None or _is_fallback(entry.data, date):
+        return entry
+    data = _with_thumbnail(entry.data)
+    if data is None:
+        return entry
+    blob = json.dumps(data).encode('utf-8')
+    _json_store.put(date, blob)
+    entry = _Entry(data, blob, entry.expires)
+    _json_memory_cache.put(date, entry)
+    return entry
+
+def _entry_for(date):
+    try:
+        entry = _json_memory_cache.get(date)
+        if entry.is_fresh():
+            metrics.CACHE_LOOKUPS.inc(result='memory_hit')
+            return _completed(date, entry)
+    except KeyError:
+        pass
+
+    expires = _expiry_for(date)
+    if expires is not None and time.time() >= expires:
+        metrics.CACHE_LOOKUPS.inc(result='miss')
+        raise KeyError(date)
+
+    try:
+        with metrics.CACHE_SECONDS.time(operation='read'):
+            blob = _json_store.get(date)
+            data = json.loads(blob.decode('utf-8'))
+    except KeyError:
+        metrics.CACHE_LOOKUPS.inc(result='miss')
+        raise
+    except ValueError:
+        # e.g. truncated by an interrupted write of an older version; drop it
+        # so that the entry is fetched again and replaced
+        LOG.error('Corrupt JSON cache entry for ' + str(date))
+        _json_store.delete(date)
+        metrics.CACHE_LOOKUPS.inc(result='miss')
+        raise KeyError(date)
+
+    metrics.CACHE_LOOKUPS.inc(result='store_hit')
+    entry = _Entry(data, blob, expires)
+    _json_memory_cache.put(date, entry)
+    return _completed(date, entry)
+
+def cached_entry_for(date):
+    """
+    Returns (data, expires, etag) for the cached entry of the date, where
+    expires is when it is due for revalidation (None: never). Raises KeyError
+    if there is none, or if it is a recent one due for revalidation.
+    """
+    entry = _entry_for(date)
+    # callers are free to modify what they get back, so hand out copies
+    return dict(entry.data), entry.expires, entry.etag
 
 def cached_json_for(date):
-    with open(f"{CACHE_FOLDER_JSON}/{date}.json") as file:
-        data = json.load(file)
-    return data
+    """
+    Returns the cached entry of the date. Raises KeyError if there is none,
+    or if it is a recent one due for revalidation.
+    """
+    return cached_entry_for(date)[0]
+
+def cached_etag_for(date):
+    """
+    Returns (etag, expires) of the date's entry if it is in memory and fresh,
+    (None, None) otherwise. Never touches the cache files.
+    """
+    try:
+        entry = _json_memory_cache.peek(date)
+    except KeyError:
+        return None, None
+    if entry.is_fresh():
+        return entry.etag, entry.expires
+    return None, None
+
+
+# Response bodies
+
+@metrics.SERIALIZE_SECONDS.timed(kind='body')
+def response_body(blob, service_version, encoding=None):
+    """
+    Returns the response body for a serialized entry: the entry with the
+    service version added, compressed with `encoding` (None, 'gzip' or 'br').
+    """
+    body = blob.rstrip()[:-1] + b', "service_version": ' + json.dumps(service_version).encode('utf-8') + b'}'
+    if encoding == 'gzip':
+        # not gzip.compress, which stamps the current time into the header
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(body) + compressor.flush()
+    elif encoding == 'br':
+        body = brotli.compress(body)
+    return body
+
+def encoded_body_for(date, service_version, encoding=None):
+    """
+    Returns (body, expires, etag) for the cached entry of the date, body being
+    its final response_body. Bodies are built once: they are kept with the
+    entry in memory and compressed ones are also stored next to the entry, so
+    serving them takes no serialization or compression. Raises KeyError like
+    cached_entry_for.
+    """
+    entry = _entry_for(date)
+    body = entry.bodies.get((service_version, encoding))
+    if body is None:
+        body = _stored_body_for(date, entry, service_version, encoding)
+        entry.bodies[(service_version, encoding)] = body
+    return body, entry.expires, entry.etag
+
+def _stored_body_for(date, entry, service_version, encoding):
+    if encoding is None:
+        return response_body(entry.blob, service_version)
+
+    # stored bodies start with the tag of what they were built from
+    tag = (service_version + '-' + entry.etag + '\n').encode('utf-8')
+    body_store = _body_stores[encoding]
+    try:
+        record = body_store.get(date)
+        if record.startswith(tag):
+            return record[len(tag):]
+    except KeyError:
+        pass
+
+    body = response_body(entry.blob, service_version, encoding)
+    if not _is_fallback(entry.data, date):
+        body_store.put(date, tag + body)
+    return body
 
 def cached_json_exists_for(date):
-    return os.path.exists(f"{CACHE_FOLDER_JSON}/{date}.json")
+    return _json_store.exists(date)
+
+@metrics.CACHE_SECONDS.timed(operation='read_range')
+def cached_json_range(start_date, end_date):
+    """
+    Returns the serialized (bytes) JSON entries for every date from start_date
+    to end_date inclusive, in date order, with None for dates not yet cached.
+    """
+    entries = _json_store.get_range(start_date, end_date)
+    recent_ordinal = datetime.today().toordinal() - 1
+    for idx, entry in enumerate(entries):
+        if entry is None:
+            continue
+        dt = start_date + timedelta(days=idx)
+        # cheap check against truncated entries, which would break the array
+        if not (entry.startswith(b'{') and entry.rstrip().endswith(b'}')):
+            LOG.error('Corrupt JSON cache entry for ' + str(dt))
+            entries[idx] = None
+        elif dt.toordinal() >= recent_ordinal and time.time() >= _expiry_for(dt):
+            entries[idx] = None  # due for revalidation
+        elif _NO_THUMBNAIL in entry:
+            entries[idx] = _completed_blob(dt, entry)
+    misses = entries.count(None)
+    metrics.CACHE_LOOKUPS.inc(len(entries) - misses, result='store_hit')
+    metrics.CACHE_LOOKUPS.inc(misses, result='miss')
+    return entries
+
+
+# how an entry cached without its video thumbnail reads
+_NO_THUMBNAIL = b'"thumbnail_url": null'
+
+
+def _completed_blob(date, blob):
+    # like _completed, for a serialized entry
+    try:
+        data = json.loads(blob.decode('utf-8'))
+    except ValueError:
+        return None
+    return _completed(date, _Entry(data, blob, _expiry_for(date))).blob
+
+
+def keyword_dates(keyword, start_date=None, end_date=None):
+    """
+    Returns the dates of the cached entries tagged with the keyword, in
+    order, optionally only those from start_date to end_date (inclusive).
+    """
+    return keyword_index.dates_for(keyword, start_date, end_date)
+
+
+def cached_dates_sample(count):
+    """
+    Returns up to count dates of cached entries, drawn at random.
+    """
+    return keyword_index.sample(count)
+
+
+def fulltext_dates(text, start_date=None, end_date=None, limit=20, offset=0):
+    """
+    Returns the dates of the cached entries whose title, explanation or
+    copyright contain every word of the text, best matches first. Raises
+    SearchUnavailable if full-text search is disabled or unavailable.
+    """
+    if fulltext_index is None:
+        raise search.SearchUnavailable('Full-text search is not available')
+    return fulltext_index.search(text, start_date, end_date, limit, offset)
+
+
+def _iter_cached_json(chunk_size=500):
+    """
+    Yields (date, entry) for every entry in the JSON cache, in date order.
+    """
+    today = datetime.today().date()
+    for chunk_start in range(store.FIRST_ORDINAL, today.toordinal() + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, today.toordinal())
+        blobs = _json_store.get_range(datetime.fromordinal(chunk_start).date(), datetime.fromordinal(chunk_end).date())
+        for idx, blob in enumerate(blobs):
+            if blob is None:
+                continue
+            try:
+                data = json.loads(blob.decode('utf-8'))
+            except ValueError:
+                continue
+            yield datetime.fromordinal(chunk_start + idx).date(), data
+
+
+def reindex():
+    """
+    Rebuilds the search indexes from the JSON cache, e.g. for a cache filled
+    before they existed.
+    """
+    entries = list(_iter_cached_json())
+    keyword_index.rebuild((dt, data.get('keywords')) for dt, data in entries)
+    if fulltext_index is not None:
+        fulltext_index.rebuild(entries)
+    return len(entries)
+
+
+def compact_stores():
+    """
+    Compacts the caches kept in packed stores (see PackedStore.compact).
+    Returns the number of bytes freed.
+    """
+    stores = [_json_store, _html_store, _negative_store, _meta_store] + list(_body_stores.values())
+    return sum(cache.compact() for cache in stores if isinstance(cache, store.PackedStore))
+
+
+# Compact archive
+
+def build_archive(path):
+    """
+    Writes the compact archive of every entry in the JSON cache to the file.
+    Returns the number of entries.
+    """
+    compact = archive.CompactArchive.build(_iter_cached_json())
+    compact.save(path)
+    return len(compact)
+
+
+# the archive loaded in this process, if any; the file is mapped, not read,
+# so all worker processes share it
+compact_archive = None
+if ARCHIVE_PATH:
+    try:
+        compact_archive = archive.CompactArchive.load(ARCHIVE_PATH)
+    except (IOError, OSError, ValueError) as ex:
+        LOG.error('Could not load the archive ' + ARCHIVE_PATH + ': ' + str(ex))
+
+
+def archived_entries(dates, fields=None):
+    """
+    Returns {date: entry} for the dates found in the compact archive, with
+    only the given fields if any. Recent dates, which may have changed since
+    the archive was built, are left out.
+    """
+    if compact_archive is None:
+        return {}
+    entries = {}
+    for dt in dates:
+        if _is_recent(dt):
+            continue
+        try:
+            entries[dt] = compact_archive.get(dt, fields)
+        except KeyError:
+            pass
+    return entries
+
+
+# Negative Caching (dates without a usable entry)
+
+# reason codes
+NO_MEDIA = 'no_media'  # neither image nor video (e.g. flash only)
+PARSE_ERROR = 'parse_error'  # page layout not understood
+NOT_FOUND = 'not_found'  # no page upstream
+
+
+class NoMediaError(ValueError):
+    pass
+
+
+class ParseError(ValueError):
+    """
+    The page layout isn't understood: a field couldn't be extracted.
+    """
+    pass
+
+
+def _failure_reason(ex):
+    """
+    Returns the reason code of a failure worth remembering, None for the
+    transient ones (network trouble, upstream errors) and for local faults
+    (e.g. a full disk) or bugs, which say nothing about the date.
+    """
+    if isinstance(ex, requests.HTTPError):
+        if ex.response is not None and ex.response.status_code == 404:
+            return NOT_FOUND
+        return None
+    if isinstance(ex, NoMediaError):
+        return NO_MEDIA
+    if isinstance(ex, ParseError):
+        return PARSE_ERROR
+    return None
+
+
+def _remember_failure(dt, ex):
+    reason = _failure_reason(ex)
+    if reason is None or _is_recent(dt):
+        # today's page may not be up (or fixed) yet
+        return
+    record = {'reason': reason, 'message': str(ex), 'time': time.time()}
+    _negative_store.put(dt, json.dumps(record).encode('utf-8'))
+
+
+def _is_fresh_negative(record):
+    return time.time() - record['time'] < NEGATIVE_CACHE_TTL
+
+
+def negative_cached_for(dt):
+    """
+    Returns the record ({'reason', 'message', 'time'}) of a date known not to
+    have a usable entry, or None.
+    """
+    try:
+        record = json.loads(_negative_store.get(dt).decode('utf-8'))
+    except (KeyError, ValueError):
+        return None
+    return record if _is_fresh_negative(record) else None
+
+
+def negative_cached_range(start_date, end_date):
+    """
+    Returns the reason code for every date from start_date to end_date
+    inclusive known not to have a usable entry, None for the others.
+    """
+    reasons = []
+    for blob in _negative_store.get_range(start_date, end_date):
+        reason = None
+        if blob is not None:
+            try:
+                record = json.loads(blob.decode('utf-8'))
+                if _is_fresh_negative(record):
+                    reason = record['reason']
+            except ValueError:
+                pass
+        reasons.append(reason)
+    return reasons
+
+
+def _check_negative(dt):
+    record = negative_cached_for(dt)
+    if record:
+        metrics.CACHE_LOOKUPS.inc(result='negative')
+        LOG.debug('known unusable date ' + str(dt) + ': ' + record['reason'])
+        raise ValueError(record['message'])
 
 
 # HTML Caching (internal use only)
 
 def _cached_html_for(date):
-    with open(f"{CACHE_FOLDER_HTML}/{_html_filename_for(date)}") as file:
-        content = file.read()
-    return content
+    return _html_store.get(date).decode('utf-8')
 
 def _cache_html(content, date):
-    with open(f"{CACHE_FOLDER_HTML}/{_html_filename_for(date)}", "w") as file:
-        file.write(content)
+    _html_store.put(date, content.encode('utf-8'))
 
-def _html_filename_for(date):
-    date_str = date.strftime('%y%m%d')
-    return f"ap{date_str}.html"
+
+# Upstream HTTP
+
+def _new_session():
+    retry = Retry(total=UPSTREAM_RETRIES, backoff_factor=UPSTREAM_BACKOFF,
+                  status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE,
+                          max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# never share sockets with a parent process (e.g. gunicorn --preload)
+_session = perprocess.PerProcess(_new_session)
+
+
+def _http():
+    """
+    Returns the process wide requests session, so that upstream fetches reuse
+    keep-alive connections instead of opening a new one for every date.
+    """
+    return _session.get()
+
+
+def _http_get(url, headers=None):
+    try:
+        with metrics.UPSTREAM_SECONDS.time():
+            response = _http().get(url, headers=headers, timeout=UPSTREAM_TIMEOUT)
+    except requests.RequestException as ex:
+        metrics.UPSTREAM_ERRORS.inc(reason=type(ex).__name__)
+        raise
+    if response.status_code >= 400:
+        metrics.UPSTREAM_ERRORS.inc(reason=str(response.status_code))
+    return response
+
+
+# Video thumbnails
+
+# thumbnail urls by provider and video id, e.g. 'vimeo-12345'
+_thumbs_store = store.FileStore(CACHE_FOLDER_THUMBS, lambda key: f"{key}.json")
+_thumbs_memory = {}
+# videos whose thumbnail was looked up again for an entry cached without it
+_thumbs_retried = set()
+
+_thumbs_executor = perprocess.PerProcess(lambda: ThreadPoolExecutor(4))
+
+
+def _thumbnail_executor():
+    return _thumbs_executor.get()
+
+
+def _known_thumbnail(key):
+    """
+    Returns the thumbnail url for the key if it is known (in memory or in the
+    thumbnail cache). Raises KeyError otherwise.
+    """
+    try:
+        return _thumbs_memory[key]
+    except KeyError:
+        pass
+
+    try:
+        url = json.loads(_thumbs_store.get(key).decode('utf-8'))['thumbnail_url']
+    except ValueError:
+        raise KeyError(key)
+    _thumbs_memory[key] = url
+    return url
+
+
+def _cached_thumbnail(key, lookup):
+    """
+    Returns the thumbnail url for the key, calling lookup() only if it isn't
+    known yet.
+    """
+    try:
+        return _known_thumbnail(key)
+    except KeyError:
+        pass
+
+    url = lookup()
+    _thumbs_store.put(key, json.dumps({'thumbnail_url': url}).encode('utf-8'))
+    _thumbs_memory[key] = url
+    return url
+
+
+def _vimeo_thumbnail(vimeo_id):
+    # make an API call to get thumbnail URL
+    response = _http().get(f"https://vimeo.com/api/v2/video/{vimeo_id}.json", timeout=THUMBNAIL_TIMEOUT)
+    response.raise_for_status()
+    return response.json()[0]['thumbnail_large']
 
 
 # function for getting video thumbnails
 def _get_thumbs(data):
-    if _youtube_video_id_from(data):
-        return "https://img.youtube.com/vi/" + _youtube_video_id_from(data) + "/0.jpg"
+    video = media.classify(data)
+    if video.provider == 'vimeo':
+        try:
+            if not video.id:
+                raise ValueError('no video id')
+            return _cached_thumbnail('vimeo-' + video.id, lambda: _vimeo_thumbnail(video.id))
+        except Exception as ex:
+            # a missing thumbnail shouldn't cost us the whole entry
+            LOG.error('No thumbnail for ' + data + ': ' + str(ex))
+            return None
+    return video.thumbnail
 
-    elif "vimeo" in data:
-        # get ID from Vimeo URL
-        vimeo_id_regex = re.compile("(?:/video/)(\d+)")
-        vimeo_id = vimeo_id_regex.findall(data)[0]
-        # make an API call to get thumbnail URL
-        response = requests.get(f"https://vimeo.com/api/v2/video/{vimeo_id}.json")
-        return response.json()[0]['thumbnail_large']
+
+def _thumbnail_of(future):
+    try:
+        return future.result(THUMBNAIL_TIMEOUT)
+    except TimeoutError:
+        # the lookup carries on and caches the thumbnail, which _with_thumbnail
+        # adds to the cached entry later on
+        LOG.error('Timed out getting the video thumbnail')
+        return None
+
+
+def _with_thumbnail(data):
+    """
+    Returns the entry of a Vimeo video cached without its thumbnail (the
+    lookup timed out or failed) with the thumbnail found since, None if there
+    is still none. Failed lookups are tried again once per process.
+    """
+    video = media.classify(data.get('url') or '')
+    if video.provider != 'vimeo' or not video.id:
+        return None
+    key = 'vimeo-' + video.id
+    try:
+        url = _known_thumbnail(key)
+    except KeyError:
+        if key not in _thumbs_retried:
+            _thumbs_retried.add(key)
+            _thumbnail_executor().submit(_get_thumbs, data['url'])
+        return None
+    return dict(data, thumbnail_url=url) if url else None
 
 
 def _youtube_video_id_from(url):
     if not url:
         return None
-    regex = "(?:http:|https:)*?\/\/(?:www\.|)(?:youtube\.com|m\.youtube\.com|youtu\.|youtube-nocookie\.com).*(?:v=|v%3D|v\/|(?:a|p)\/(?:a|u)\/\d.*\/|watch\?|vi(?:=|\/)|\/embed\/|oembed\?|be\/|e\/)([^&?%#\/\n]*)"
-    video_id = re.compile(regex).findall(url)  # returns an array
-    return ''.join(video_id)  # get id or empty string
+    return media.youtube_id(url)  # get id or empty string
 
 
 def _query(url):
@@ -88,58 +908,238 @@ def _query(url):
     return "?" + query if query else ""
 
 
-def _get_apod_chars(dt):
+def _get_apod_chars(dt, revalidate=False):
+    _check_negative(dt)
+    try:
+        return _apod_chars_from(_get_apod_html(dt, revalidate), dt)
+    except Exception as ex:
+        _remember_failure(dt, ex)
+        raise
+
+
+def _get_apod_html(dt, revalidate=False):
+    """
+    Returns the APOD HTML page for the given date, from the HTML cache if
+    possible, otherwise downloaded (and cached) from the APOD site. Cached
+    pages of recent dates are revalidated with a conditional request once
+    they are older than RECENT_TTL, or right away with `revalidate`; when that
+    fails for a transient reason, the cached page is served stale.
+    """
+    recent = _is_recent(dt)
+    meta = _meta_for(dt) if recent else None
     try:
         html_content = _cached_html_for(dt)
     except:
-        apod_url = os.path.join(BASE, _html_filename_for(dt))
-        LOG.debug('OPENING URL:' + apod_url)
-        response = requests.get(apod_url)
-        response.raise_for_status()
+        html_content = None
+        meta = None
+    else:
+        if not recent or (meta and not revalidate and time.time() < meta['checked'] + RECENT_TTL):
+            return html_content
+
+    headers = {}
+    if meta and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    apod_url = os.path.join(BASE, _html_filename_for(dt))
+    LOG.debug('OPENING URL:' + apod_url)
+    try:
+        response = _http_get(apod_url, headers)
+        if response.status_code != 304 or html_content is None:
+            response.raise_for_status()
+    except Exception as ex:
+        if html_content is None or _failure_reason(ex) is not None:
+            raise
+        # the site is down (or struggling): serve the cached page, stale, and
+        # leave the site alone for another RECENT_TTL instead of trying again
+        # on every request
+        LOG.error('Could not revalidate ' + apod_url + ', serving it from cache: ' + str(ex))
+        _meta_store.put(dt, json.dumps(dict(meta or {}, checked=time.time())).encode('utf-8'))
+        return html_content
+
+    if response.status_code == 304 and html_content is not None:
+        LOG.debug('not modified: ' + apod_url)
+    else:
         html_content = response.text
         _cache_html(html_content, dt)
 
-    soup = BeautifulSoup(html_content, 'html.parser')
+    if recent:
+        meta = {
+            'checked': time.time(),
+            'etag': response.headers.get('ETag', (meta or {}).get('etag')),
+            'last_modified': response.headers.get('Last-Modified', (meta or {}).get('last_modified')),
+        }
+        _meta_store.put(dt, json.dumps(meta).encode('utf-8'))
+
+    return html_content
+
+
+class _Page(object):
+    """
+    The parsed APOD page, walked once. Collects every tag (by name, in
+    document order) and every HTML comment, so that the extractors below
+    look things up in lists instead of each searching the whole tree again.
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+        self._tags = []
+        self._by_name = {}
+        self._comments = []
+
+        for element in soup.descendants:
+            if isinstance(element, Tag):
+                self._tags.append(element)
+                self._by_name.setdefault(element.name, []).append(element)
+            elif isinstance(element, Comment):
+                self._comments.append(element)
+
+    def find_all(self, *names):
+        """
+        Returns the tags with any of the given names, in document order.
+        """
+        if len(names) == 1:
+            return self._by_name.get(names[0], [])
+        return [tag for tag in self._tags if tag.name in names]
+
+    def find(self, name):
+        """
+        Returns the first tag with the given name, or None.
+        """
+        tags = self._by_name.get(name)
+        return tags[0] if tags else None
+
+    def find_with_string(self, *names):
+        """
+        Returns the tags with any of the given names having a single string
+        (the equivalent of soup.find_all(names, text=True)).
+        """
+        return [tag for tag in self.find_all(*names) if tag.string is not None]
+
+    @property
+    def comments(self):
+        return self._comments
+
+    @property
+    def text(self):
+        return self.soup.text
+
+    def decompose(self, tag):
+        """
+        Removes the tag and its contents from the page (and from the lookups).
+        """
+        gone = set(id(element) for element in tag.descendants)
+        gone.add(id(tag))
+        tag.decompose()
+
+        self._tags = [element for element in self._tags if id(element) not in gone]
+        self._by_name = dict((name, [element for element in tags if id(element) not in gone])
+                             for name, tags in self._by_name.items())
+        self._comments = [comment for comment in self._comments if id(comment) not in gone]
+
+
+# parser name -> whether it can be used here
+PARSER_BACKENDS = OrderedDict([
+    ('html.parser', True),  # pure Python, always available
+    ('lxml', lxml is not None),  # C, several times faster
+])
+
+
+@functools.lru_cache(maxsize=None)
+def parser_backend(name=None):
+    """
+    Returns the name of the parser to use for `name` (default: HTML_PARSER),
+    falling back to html.parser when the requested one isn't installed.
+    """
+    name = name or HTML_PARSER
+    if name not in PARSER_BACKENDS:
+        raise ValueError('Unknown HTML parser %s, expected one of %s' % (name, ', '.join(PARSER_BACKENDS)))
+    if not PARSER_BACKENDS[name]:
+        LOG.warning(name + ' is not installed, parsing with html.parser')
+        return 'html.parser'
+    return name
+
+
+@metrics.PARSE_SECONDS.timed(stage='soup')
+def _parse_page(html_content, parser=None):
+    """
+    Parses the HTML with the given parser backend. Returns the _Page the
+    extractors work on.
+    """
+    return _Page(BeautifulSoup(html_content, parser_backend(parser)))
+
+
+@metrics.PARSE_SECONDS.timed(stage='page')
+def _apod_chars_from(html_content, dt, parser=None):
+    """
+    Parses the APOD HTML page of the given date into the APOD properties.
+    Raises NoMediaError if it has neither an image nor a video, ParseError if
+    some other field can't be extracted.
+    """
+    try:
+        props, thumbnail = _page_chars(_parse_page(html_content, parser), dt)
+    except NoMediaError:
+        raise
+    except Exception as ex:
+        raise ParseError(str(ex)) from ex
+
+    if thumbnail is not None:
+        props['thumbnail_url'] = _thumbnail_of(thumbnail)
+
+    return props
+
+
+def _page_chars(page, dt):
+    """
+    Extracts the APOD properties from the parsed page. Returns them and, for
+    videos, the future of the thumbnail url (still to be added).
+    """
     LOG.debug('getting the data url')
     data = None
     hd_data = None
 
-    if soup.img:
+    if page.find('img'):
         media_type = 'image'
-        data = BASE + soup.img['src']
+        data = BASE + page.find('img')['src']
 
         LOG.debug('getting the link for hd_data')
-        for link in soup.find_all('a', href=True):
-            if link['href'] and link['href'].startswith('image'):
+        for link in page.find_all('a'):
+            if link.get('href') and link['href'].startswith('image'):
                 hd_data = BASE + link['href']
                 break
     else:
         media_type = 'video'
-        if soup.iframe:
-            data = soup.iframe['src']
-        elif soup.object and _youtube_video_id_from(soup.object.embed["src"]):
+        if page.find('iframe'):
+            data = page.find('iframe')['src']
+        elif page.find('object') and _youtube_video_id_from(page.find('object').embed["src"]):
             # old way of embedding videos
-            url = soup.object.embed["src"]
+            url = page.find('object').embed["src"]
             # generating new URL because the old url structure is not recognized by youtube anymore
             # and query params could contain start position
             data = "https://youtu.be/" + _youtube_video_id_from(url) + _query(url)
 
     if not data:
         # Ignore the entry if we can't get neither an image nor a video url (flash/unsupported video)
-        raise ValueError("Neither image nor video is available for this date")
+        raise NoMediaError("Neither image nor video is available for this date")
+
+    thumbnail = None
+    if media_type == "video":
+        # the thumbnail may take an API call, get it while we parse the rest
+        thumbnail = _thumbnail_executor().submit(_get_thumbs, data)
 
     props = {}
 
-    props['explanation'] = _explanation(soup)
-    props['title'] = _title(soup)
+    props['explanation'] = _explanation(page)
+    props['title'] = _title(page)
     props['media_type'] = media_type
     props['date'] = dt.isoformat()
     
-    copyright_text = _copyright(soup)
+    copyright_text = _copyright(page)
     if copyright_text:
         props['copyright'] = copyright_text
 
-    keywords = _keywords(soup)
+    keywords = _keywords(page)
     if keywords:
         props['keywords'] = keywords
     
@@ -148,22 +1148,20 @@ def _get_apod_chars(dt):
     if hd_data and hd_data != data:
         props['hdurl'] = hd_data
 
-    if media_type == "video":
-        props['thumbnail_url'] = _get_thumbs(data)
-
-    return props
+    return props, thumbnail
 
 
-def _title(soup):
+@metrics.PARSE_SECONDS.timed(stage='title')
+def _title(page):
     """
-    Accepts a BeautifulSoup object for the APOD HTML page and returns the
+    Accepts the parsed APOD HTML page (a _Page) and returns the
     APOD image title.  Highly idiosyncratic with adaptations for different
     HTML structures that appear over time.
     """
     LOG.debug('getting the title')
     try:
         # Handler for later APOD entries
-        center_selection = soup.find_all('center')[1]
+        center_selection = page.find_all('center')[1]
         bold_selection = center_selection.find_all('b')[0]
         title = bold_selection.text.strip(' ')
         try:
@@ -174,7 +1172,7 @@ def _title(soup):
         return title
     except Exception:
         # Handler for early APOD entries
-        text = soup.title.text.split(' - ')[-1]
+        text = page.find('title').text.split(' - ')[-1]
         title = text.strip()
         try:
             title = title.encode('latin1').decode('cp1252')
@@ -184,9 +1182,10 @@ def _title(soup):
         return title
 
 
-def _copyright(soup):
+@metrics.PARSE_SECONDS.timed(stage='copyright')
+def _copyright(page):
     """
-    Accepts a BeautifulSoup object for the APOD HTML page and returns the
+    Accepts the parsed APOD HTML page (a _Page) and returns the
     APOD image copyright.  Highly idiosyncratic with adaptations for different
     HTML structures that appear over time.
     """
@@ -198,7 +1197,7 @@ def _copyright(soup):
 
         copyright_text = None
         use_next = False
-        for element in soup.findAll('a', text=True):
+        for element in page.find_with_string('a'):
             # LOG.debug("TEXT: "+element.text)
 
             if use_next:
@@ -211,7 +1210,7 @@ def _copyright(soup):
 
         if not copyright_text:
 
-            for element in soup.findAll(['b', 'a'], text=True):
+            for element in page.find_with_string('b', 'a'):
                 # search text for explicit match
                 if 'Copyright' in element.text:
                     LOG.debug('Found Copyright text:' + str(element.text))
@@ -239,9 +1238,10 @@ def _copyright(soup):
         raise ValueError('Unsupported schema for given date.')
 
 
-def _keywords(soup):
+@metrics.PARSE_SECONDS.timed(stage='keywords')
+def _keywords(page):
     """
-    Accepts a BeautifulSoup object for the APOD HTML page and returns the
+    Accepts the parsed APOD HTML page (a _Page) and returns the
     content of the `keywords` meta.
     """
     LOG.debug('getting the keywords')
@@ -249,12 +1249,11 @@ def _keywords(soup):
 
     try:
         # Handle later APOD entries
-        meta = soup.find("meta", attrs={"name": "keywords"})
+        meta = next(tag for tag in page.find_all("meta") if tag.get("name") == "keywords")
         raw_keywords = meta["content"]
     except Exception:
         # Handler for early APOD entries
-        comments = soup.findAll(text=lambda text:isinstance(text, Comment))
-        for comment in comments:
+        for comment in page.comments:
             comment = comment.lower()
             if "keywords:" not in comment: continue
             raw_keywords = comment.split("keywords:")[1]
@@ -271,14 +1270,15 @@ def _keywords(soup):
         return None
 
 
-def _explanation(soup):
+@metrics.PARSE_SECONDS.timed(stage='explanation')
+def _explanation(page):
     """
-    Accepts a BeautifulSoup object for the APOD HTML page and returns the
+    Accepts the parsed APOD HTML page (a _Page) and returns the
     APOD image explanation.  Highly idiosyncratic.
     """
     # Handler for later APOD entries
     LOG.debug('getting the explanation')
-    s = soup.find_all('p')[2]
+    s = page.find_all('p')[2]
 
     footer = s.find('p')
     if footer:
@@ -286,7 +1286,7 @@ def _explanation(soup):
             # old structure
             s = footer
         else:
-            footer.decompose()
+            page.decompose(footer)
 
     s = s.text
     s = s.replace('\n', ' ')
@@ -301,7 +1301,7 @@ def _explanation(soup):
     
     if s == '':
         # Handler for earlier APOD entries
-        texts = [x.strip() for x in soup.text.split('\n')]
+        texts = [x.strip() for x in page.text.split('\n')]
         try:
             begin_idx = texts.index('Explanation:') + 1
         except ValueError as e:
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the media url classification.
+
+Compares the per-call cost of media.classify (precompiled patterns, provider
+pre-check, memo) and of its unmemoized path with the former code, which
+compiled the patterns on every call, over embed urls as found on APOD pages.
+
+    python benchmarks/bench_media.py [--number N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from apod import media
+
+CORPUS = [
+    "https://www.youtube.com/embed/1R5QqfCcAoQ?rel=0",
+    "https://www.youtube.com/embed/dlr5jMh6gmw?rel=0&start=12",
+    "https://www.youtube.com/embed/Bnfdw8QlFZE?rel=0",
+    "https://www.youtube.com/embed/videoseries?list=PL0_OKh7HnGMX7EbAvmb9ceB0VB5S1W3ga",
+    "https://www.youtube-nocookie.com/embed/ZyxlKQbiWo8?rel=0",
+    "//www.youtube.com/embed/h3DLJeBsMY4?rel=0",
+    "http://www.youtube.com/v/8RBkk4m6Mp8&hl=en&fs=1",
+    "http://www.youtube.com/v/bVEBtQj0Co8&hl=en_US&fs=1&start=20",
+    "https://player.vimeo.com/video/178467393?color=ffffff&title=0&byline=0&portrait=0",
+    "https://player.vimeo.com/video/382802564",
+    "https://player.vimeo.com/video/22439234?title=0&byline=0&portrait=0&color=ffffff",
+    "https://apod.nasa.gov/apod/image/2104/Ingenuity_FirstFlight_1080.mp4",
+    "https://apod.nasa.gov/apod/image/1910/MoonCraters_Cole.webm",
+    "https://apod.nasa.gov/apod/image/1711/Eclipse_Sun_Interactive.html",
+    "https://www.ustream.tv/embed/17074538?html5ui",
+    "https://earth.nullschool.net/#current/wind/surface/level/orthographic",
+]
+
+
+def _legacy_classify(url):
+    # the former code: both patterns compiled on every call (re's own pattern
+    # cache turns that into a lookup, but the regex runs on every url)
+    regex = "(?:http:|https:)*?\\/\\/(?:www\\.|)(?:youtube\\.com|m\\.youtube\\.com|youtu\\.|youtube-nocookie\\.com).*(?:v=|v%3D|v\\/|(?:a|p)\\/(?:a|u)\\/\\d.*\\/|watch\\?|vi(?:=|\\/)|\\/embed\\/|oembed\\?|be\\/|e\\/)([^&?%#\\/\\n]*)"
+    video_id = ''.join(re.compile(regex).findall(url))
+    if video_id:
+        return video_id
+    if "vimeo" in url:
+        return re.compile("(?:/video/)(\\d+)").findall(url)[0]
+
+
+def _per_call(func, number):
+    # best of a few repeats, in microseconds per url
+    seconds = min(timeit.repeat(lambda: [func(url) for url in CORPUS], number=number, repeat=5))
+    return seconds / (number * len(CORPUS)) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000, help='passes over the corpus per repeat')
+    args = parser.parse_args(argv)
+
+    results = [
+        ('legacy (compiled per call)', _per_call(_legacy_classify, args.number)),
+        ('classify, unmemoized', _per_call(media.classify.__wrapped__, args.number)),
+        ('classify', _per_call(media.classify, args.number)),
+    ]
+    print('%d urls, %d passes' % (len(CORPUS), args.number))
+    for name, micros in results:
+        print('%-28s %8.3f us/url' % (name, micros))
+
+
+if __name__ == '__main__':
+    main()
@@ -53,6 +53,12 @@ setup(
     long_description=long_description,
 
     scripts=scripts,
+    entry_points={
+        'console_scripts': [
+            'apod-prewarm=apod.prewarm:main',
+            'apod-prefetch=apod.scheduler:main',
+        ],
+    },
 
     maintainer='Brian Thomas',
     maintainer_email='brian.a.thomas@nasa.gov',
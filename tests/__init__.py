@@ -0,0 +1,12 @@
+#!/bin/sh/python
+# coding= utf-8
+import atexit
+import os
+import shutil
+import tempfile
+
+# the caches (and metrics snapshots) of test runs go to a folder of their own,
+# never to the working tree; set before any apod module is imported
+if 'APOD_CACHE_FOLDER' not in os.environ:
+    os.environ['APOD_CACHE_FOLDER'] = tempfile.mkdtemp(prefix='apod-tests-')
+    atexit.register(shutil.rmtree, os.environ['APOD_CACHE_FOLDER'], True)
@@ -0,0 +1,50 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from apod import archive
+from datetime import date
+
+ENTRIES = [
+    (date(2001, 1, 12), {'explanation': 'The Crab nebula.', 'title': 'Crab', 'media_type': 'image',
+                         'date': '2001-01-12', 'copyright': 'R. Gendler', 'keywords': ['crab', 'nebula'],
+                         'url': 'https://apod.nasa.gov/apod/image/0101/crab.jpg',
+                         'hdurl': 'https://apod.nasa.gov/apod/image/0101/crab_big.jpg'}),
+    (date(2001, 1, 10), {'explanation': 'A video of Orion, Ω.', 'title': 'Orion', 'media_type': 'video',
+                         'date': '2001-01-10', 'keywords': ['nebula'],
+                         'url': 'https://player.vimeo.com/video/1', 'thumbnail_url': None}),
+]
+
+
+class TestCompactArchive(unittest.TestCase):
+    """Test the columnar archive of entries."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_entries(self):
+        compact = archive.CompactArchive.build(ENTRIES)
+        self.assertEqual(len(compact), 2)
+        self.assertEqual(compact.dates(), [date(2001, 1, 10), date(2001, 1, 12)])
+        for dt, data in ENTRIES:
+            self.assertEqual(compact.get(dt), data)
+        self.assertRaises(KeyError, compact.get, date(2001, 1, 11))
+        self.assertNotIn(date(2001, 1, 11), compact)
+
+    def test_projection(self):
+        compact = archive.CompactArchive.build(ENTRIES)
+        self.assertEqual(compact.get(date(2001, 1, 10), fields=['url', 'thumbnail_url', 'date', 'hdurl']),
+                         {'date': '2001-01-10', 'url': 'https://player.vimeo.com/video/1', 'thumbnail_url': None})
+        self.assertEqual(list(compact.range(date(2001, 1, 11), date(2001, 1, 31), fields=['title'])),
+                         [(date(2001, 1, 12), {'title': 'Crab'})])
+
+    def test_save_and_load(self):
+        path = os.path.join(self.folder, 'archive.bin')
+        archive.CompactArchive.build(ENTRIES).save(path)
+        compact = archive.CompactArchive.load(path)
+        self.assertEqual(dict(compact.range(date(2001, 1, 1), date(2001, 1, 31))), dict(ENTRIES))
@@ -0,0 +1,253 @@
+#!/bin/sh/python
+# coding= utf-8
+import asyncio
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import requests
+from apod import store, utility
+from datetime import date
+
+# a page without image or video (e.g. flash only), and one whose layout isn't understood
+PAGE_WITHOUT_MEDIA = '<html><body><center><b>Flash</b></center><p>Flash only</p></body></html>'
+PAGE_NOT_UNDERSTOOD = '<html><body><img src="image/1701/nebula.jpg"></body></html>'
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test the in-memory cache sitting in front of the file cache."""
+
+    def test_eviction_order(self):
+        cache = utility.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertRaises(KeyError, cache.get, 'b')
+
+    def test_counters(self):
+        cache = utility.LRUCache(1)
+        cache.put('a', 1)
+        cache.get('a')
+        self.assertRaises(KeyError, cache.get, 'b')
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+
+class TestPackedStore(unittest.TestCase):
+    """Test the single-file packed cache backend."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = store.PackedStore(self.folder, 'json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_roundtrip(self):
+        self.store.put(date(2017, 3, 22), b'{"a": 1}')
+        self.store.put(date(2017, 3, 22), b'{"a": 2}')
+
+        self.assertEqual(self.store.get(date(2017, 3, 22)), b'{"a": 2}')
+        self.assertTrue(self.store.exists(date(2017, 3, 22)))
+        self.assertFalse(self.store.exists(date(2017, 3, 23)))
+        self.assertRaises(KeyError, self.store.get, date(1990, 1, 1))
+
+    def test_range(self):
+        self.store.put_many([(date(1995, 6, 16), b'first'), (date(1995, 6, 18), b'third')])
+
+        blobs = self.store.get_range(date(1995, 6, 15), date(1995, 6, 19))
+        self.assertEqual(blobs, [None, b'first', None, b'third', None])
+
+    def test_compact(self):
+        self.store.put_many([(date(2017, 3, 22), b'{"a": 1}'), (date(2017, 3, 23), b'{"b": 1}'),
+                             (date(2017, 3, 24), b'{"c": 1}')])
+        self.store.put(date(2017, 3, 22), b'{"a": 2}')
+        self.store.delete(date(2017, 3, 23))
+
+        self.assertEqual(self.store.compact(), 16)
+        self.assertEqual(os.path.getsize(self.store.data_path), 16)
+        self.assertEqual(self.store.get_range(date(2017, 3, 22), date(2017, 3, 24)), [b'{"a": 2}', None, b'{"c": 1}'])
+        # and goes on as before
+        self.store.put(date(2017, 3, 23), b'{"b": 2}')
+        self.assertEqual(store.PackedStore(self.folder, 'json').get(date(2017, 3, 23)), b'{"b": 2}')
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test that concurrent misses on the same key share one call."""
+
+    def test_concurrent_calls(self):
+        flights = utility.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do('key', work))) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+
+    def test_error_is_shared(self):
+        flights = utility.SingleFlight()
+        future, leader = flights.claim('key')
+        waiter, waiter_leader = flights.claim('key')
+
+        self.assertTrue(leader)
+        self.assertFalse(waiter_leader)
+        flights.resolve('key', error=ValueError('bad page'))
+        self.assertRaises(ValueError, waiter.result)
+        # once resolved, the next caller leads a new flight
+        self.assertTrue(flights.claim('key')[1])
+
+    def test_cancellation_is_not_shared(self):
+        flights = utility.SingleFlight()
+        flights.claim('key')
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(flights.do('key', lambda: 'result')))
+        waiter.start()
+        time.sleep(0.1)
+
+        # the waiter takes over instead of failing with the leader
+        flights.resolve('key', error=asyncio.CancelledError())
+        waiter.join()
+        self.assertEqual(results, ['result'])
+
+
+class TestAtomicWrites(unittest.TestCase):
+    """Test that cache writes replace entries atomically and corrupt entries are detected."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_file_store_leaves_no_temporary_files(self):
+        files = store.FileStore(self.folder, lambda dt: f"{dt}.json")
+        files.put(date(2017, 3, 22), b'{"a": 1}')
+        files.put(date(2017, 3, 22), b'{"a": 2}')
+
+        self.assertEqual(os.listdir(self.folder), ['2017-03-22.json'])
+        self.assertEqual(files.get(date(2017, 3, 22)), b'{"a": 2}')
+
+    def test_packed_store_checksum(self):
+        packed = store.PackedStore(self.folder, 'json')
+        packed.put(date(2017, 3, 22), b'{"a": 1}')
+
+        # flip the stored bytes behind the store's back
+        with open(packed.data_path, 'r+b') as file:
+            file.write(b'{"b"')
+
+        self.assertRaises(KeyError, packed.get, date(2017, 3, 22))
+        self.assertEqual(packed.get_range(date(2017, 3, 22), date(2017, 3, 22)), [None])
+
+    def test_file_mode(self):
+        files = store.FileStore(self.folder, lambda dt: f"{dt}.json")
+        files.put(date(2017, 3, 22), b'{"a": 1}')
+
+        # readable by whoever else serves the cache, as umask allows
+        mode = os.stat(files.path_for(date(2017, 3, 22))).st_mode & 0o777
+        self.assertEqual(mode, 0o666 & ~store._umask())
+
+    def test_packed_store_locks_forked_workers_out(self):
+        # like gunicorn --preload: the store is opened before the fork
+        packed = store.PackedStore(self.folder, 'json')
+        fcntl.lockf(packed._data_fd, fcntl.LOCK_EX)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                packed.put(date(2017, 3, 22), b'{"a": 1}')
+            finally:
+                os._exit(0)
+        try:
+            time.sleep(0.2)
+            # the worker waits for the lock of its parent
+            self.assertEqual(os.waitpid(pid, os.WNOHANG), (0, 0))
+        finally:
+            fcntl.lockf(packed._data_fd, fcntl.LOCK_UN)
+            os.waitpid(pid, 0)
+        self.assertEqual(packed.get(date(2017, 3, 22)), b'{"a": 1}')
+
+
+class TestNegativeCache(unittest.TestCase):
+    """Test the remembering of dates without a usable entry."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        patch = mock.patch.object(utility, '_negative_store', store.FileStore(self.folder, lambda dt: f"{dt}.json"))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _get(self, dt, **page):
+        # _get_apod_chars with the page (or its failure) mocked; returns the mock
+        with mock.patch.object(utility, '_get_apod_html', **page) as get_html:
+            with self.assertRaises(Exception):
+                utility._get_apod_chars(dt)
+        return get_html
+
+    def _reason(self, dt):
+        record = utility.negative_cached_for(dt)
+        return record and record['reason']
+
+    def test_recorded(self):
+        not_found = requests.HTTPError(response=mock.Mock(status_code=404))
+        self._get(date(2001, 1, 1), return_value=PAGE_WITHOUT_MEDIA)
+        self._get(date(2001, 1, 2), return_value=PAGE_NOT_UNDERSTOOD)
+        self._get(date(2001, 1, 3), side_effect=not_found)
+
+        self.assertEqual(self._reason(date(2001, 1, 1)), utility.NO_MEDIA)
+        self.assertEqual(self._reason(date(2001, 1, 2)), utility.PARSE_ERROR)
+        self.assertEqual(self._reason(date(2001, 1, 3)), utility.NOT_FOUND)
+        # and not fetched again
+        self.assertFalse(self._get(date(2001, 1, 1), return_value=PAGE_WITHOUT_MEDIA).called)
+        self.assertEqual(utility.negative_cached_range(date(2000, 12, 31), date(2001, 1, 4)),
+                         [None, utility.NO_MEDIA, utility.PARSE_ERROR, utility.NOT_FOUND, None])
+
+    def test_transient_failures(self):
+        unavailable = requests.HTTPError(response=mock.Mock(status_code=503))
+        self._get(date(2001, 1, 1), side_effect=unavailable)
+        self._get(date(2001, 1, 2), side_effect=requests.ConnectionError())
+        # local faults say nothing about the date
+        self._get(date(2001, 1, 3), side_effect=OSError(28, 'No space left on device'))
+        with mock.patch.object(utility, '_cache_html', side_effect=OSError(13, 'Permission denied')):
+            self._get(date(2001, 1, 4), side_effect=lambda dt: utility._cache_html('<html></html>', dt))
+        # today's page may not be up yet
+        self._get(date.today(), return_value=PAGE_WITHOUT_MEDIA)
+
+        for dt in [date(2001, 1, 1), date(2001, 1, 2), date(2001, 1, 3), date(2001, 1, 4), date.today()]:
+            self.assertIsNone(utility.negative_cached_for(dt))
+
+    def test_expiry(self):
+        self._get(date(2001, 1, 1), return_value=PAGE_WITHOUT_MEDIA)
+        with mock.patch.object(utility, 'NEGATIVE_CACHE_TTL', 0):
+            self.assertIsNone(utility.negative_cached_for(date(2001, 1, 1)))
+            self.assertEqual(utility.negative_cached_range(date(2001, 1, 1), date(2001, 1, 1)), [None])
+            # so the date is fetched again
+            self.assertTrue(self._get(date(2001, 1, 1), return_value=PAGE_WITHOUT_MEDIA).called)
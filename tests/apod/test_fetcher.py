@@ -0,0 +1,56 @@
+#!/bin/sh/python
+# coding= utf-8
+import asyncio
+import unittest
+from unittest import mock
+from apod import fetcher, utility
+from concurrent.futures import CancelledError
+from datetime import date
+
+ENTRY = {'date': '2017-03-22', 'title': 'Slow'}
+
+
+class TestFetcher(unittest.TestCase):
+    """Test the downloads shared by concurrent requests."""
+
+    def setUp(self):
+        self.fetcher = fetcher.Fetcher(concurrency=4, parse_mode='thread', parse_workers=1)
+        self.calls = []
+
+        async def slow_fill(dt, use_default_today_date, cache):
+            self.calls.append(dt)
+            await asyncio.sleep(0.2)
+            return dict(ENTRY)
+
+        patches = [mock.patch.object(self.fetcher, '_fill', slow_fill),
+                   mock.patch.object(utility, 'cached_json_for', side_effect=KeyError)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.fetcher.shutdown()
+
+    def test_cancelled_leader(self):
+        dt = date(2017, 3, 22)
+        leader = self.fetcher.submit(dt)
+        while not self.calls:
+            pass
+        waiter = self.fetcher.submit(dt)
+        leader.cancel()
+
+        # the fill goes on for the requests waiting on it
+        self.assertEqual(waiter.result(5), ENTRY)
+        self.assertEqual(utility.fill_flights.do((dt, False), lambda: 'another fill'), 'another fill')
+        self.assertRaises(CancelledError, leader.result)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_cancelled_waiter(self):
+        dt = date(2017, 3, 23)
+        leader = self.fetcher.submit(dt)
+        while not self.calls:
+            pass
+        waiter = self.fetcher.submit(dt)
+        waiter.cancel()
+
+        self.assertEqual(leader.result(5), ENTRY)
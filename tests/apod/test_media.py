@@ -0,0 +1,33 @@
+#!/bin/sh/python
+# coding= utf-8
+import unittest
+from apod import media, utility
+
+
+class TestClassify(unittest.TestCase):
+    """Test the classification of APOD video urls."""
+
+    def test_youtube(self):
+        for url in ("https://www.youtube.com/embed/1R5QqfCcAoQ?rel=0",
+                    "//www.youtube-nocookie.com/embed/1R5QqfCcAoQ",
+                    "http://www.youtube.com/v/1R5QqfCcAoQ&hl=en&fs=1",
+                    "https://youtu.be/1R5QqfCcAoQ?t=10"):
+            self.assertEqual(media.classify(url),
+                             media.Media('youtube', '1R5QqfCcAoQ', "https://img.youtube.com/vi/1R5QqfCcAoQ/0.jpg"),
+                             url)
+
+    def test_vimeo(self):
+        self.assertEqual(media.classify("https://player.vimeo.com/video/178467393?color=ffffff"),
+                         media.Media('vimeo', '178467393', None))
+        self.assertEqual(media.classify("https://vimeo.com/channels/staffpicks"),
+                         media.Media('vimeo', None, None))
+
+    def test_others(self):
+        self.assertEqual(media.classify("https://apod.nasa.gov/apod/image/2104/Ingenuity.mp4").provider, 'file')
+        self.assertEqual(media.classify("https://www.ustream.tv/embed/17074538").provider, 'other')
+        self.assertEqual(media.classify(""), media.Media('other', None, None))
+
+    def test_thumbnails(self):
+        self.assertEqual(utility._get_thumbs("https://www.youtube.com/embed/1R5QqfCcAoQ?rel=0"),
+                         "https://img.youtube.com/vi/1R5QqfCcAoQ/0.jpg")
+        self.assertIsNone(utility._get_thumbs("https://www.ustream.tv/embed/17074538"))
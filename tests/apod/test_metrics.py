@@ -0,0 +1,72 @@
+#!/bin/sh/python
+# coding= utf-8
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from apod import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the metrics and their aggregation across processes."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved_folder = metrics.METRICS_FOLDER
+        metrics.METRICS_FOLDER = self.folder
+        self.counter = metrics.Counter('test_requests_total', 'Requests.', ['result'])
+        self.histogram = metrics.Histogram('test_seconds', 'Time.', buckets=(0.1, 1))
+
+    def tearDown(self):
+        del metrics._registry['test_requests_total']
+        del metrics._registry['test_seconds']
+        metrics.METRICS_FOLDER = self.saved_folder
+        shutil.rmtree(self.folder)
+
+    def _other_process(self, pid, value):
+        snapshot = {'pid': pid, 'metrics': {
+            'test_requests_total': {'type': 'counter', 'help': 'Requests.', 'labels': ['result'],
+                                    'samples': [[['hit'], value]]},
+            'test_gauge': {'type': 'gauge', 'help': 'Depth.', 'labels': [], 'samples': [[[], 7]]},
+        }}
+        with open(os.path.join(self.folder, '%d.json' % pid), 'w') as file:
+            json.dump(snapshot, file)
+
+    def test_exposition(self):
+        self.counter.inc(result='hit')
+        self.counter.inc(2, result='miss')
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        with self.histogram.time():
+            pass
+
+        lines = metrics.exposition().splitlines()
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{result="hit"} 1', lines)
+        self.assertIn('test_requests_total{result="miss"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count 3', lines)
+
+    def test_processes_add_up(self):
+        self.counter.inc(result='hit')
+        # the parent process is alive, pid 2 ** 22 + 1 can't be
+        self._other_process(os.getppid(), 3)
+        self._other_process(2 ** 22 + 1, 5)
+
+        lines = metrics.exposition().splitlines()
+        self.assertIn('test_requests_total{result="hit"} 9', lines)
+        # gauges of processes that are gone are left out
+        self.assertEqual(lines.count('test_gauge 7'), 1)
+
+    def test_exited_processes_are_folded(self):
+        self._other_process(2 ** 22 + 1, 5)
+        self._other_process(2 ** 22 + 2, 2)
+        metrics.exposition()
+
+        self.assertEqual(sorted(name for name in os.listdir(self.folder) if name.endswith('.json')),
+                         ['%d.json' % os.getpid(), metrics.EXITED])
+        # and still counted
+        self.assertIn('test_requests_total{result="hit"} 7', metrics.exposition().splitlines())
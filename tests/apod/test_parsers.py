@@ -0,0 +1,85 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import unittest
+from apod import utility
+from datetime import date
+
+# trimmed copies of APOD pages, one per layout, in tests/apod/pages
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+
+# what the original (tree-searching) parser extracted from each page
+EXPECTED = {
+    'modern page': {
+        'date': '2017-03-22',
+        'copyright': 'Robert Gendler',
+        'explanation': 'In cosmic brush strokes of glowing hydrogen gas, this beautiful skyscape unfolds.',
+        'hdurl': 'https://apod.nasa.gov/apod/image/1703/Cygnus-New-L.jpg',
+        'keywords': ['cygnus', 'butterfly nebula', 'crescent nebula'],
+        'media_type': 'image',
+        'title': 'Central Cygnus Skyscape',
+        'url': 'https://apod.nasa.gov/apod/image/1703/Cygnus-New-1024.jpg',
+    },
+    'early page, keywords in a comment': {
+        'date': '1998-06-19',
+        'explanation': "Looking down on the Northern Hemisphere of Mars on June 1, the Mars Global Surveyor "
+                       "spacecraft's wide angle camera.",
+        'hdurl': 'https://apod.nasa.gov/apod/image/9806/tharsis_mgs_big.jpg',
+        'keywords': ['mars', 'mgs'],
+        'media_type': 'image',
+        'title': 'Good Morning Mars',
+        'url': 'https://apod.nasa.gov/apod/image/9806/tharsis_mgs.gif',
+    },
+    'video in an iframe': {
+        'date': '2020-01-01',
+        'copyright': 'Jane Doe',
+        'explanation': 'Watch the Moon move.',
+        'keywords': ['moon', 'video'],
+        'media_type': 'video',
+        'thumbnail_url': 'https://img.youtube.com/vi/abcDEF12345/0.jpg',
+        'title': 'Moon Video',
+        'url': 'https://www.youtube.com/embed/abcDEF12345?rel=0',
+    },
+    'video in an object': {
+        'date': '2009-01-01',
+        'explanation': 'Flash video from the past.',
+        'media_type': 'video',
+        'thumbnail_url': 'https://img.youtube.com/vi/ZYX98765432/0.jpg',
+        'title': 'Old Video',
+        'url': 'https://youtu.be/ZYX98765432',
+    },
+}
+
+
+def page_for(dt):
+    with open(os.path.join(PAGES, utility._html_filename_for(dt)), encoding='utf-8') as file:
+        return file.read()
+
+
+class TestParserBackends(unittest.TestCase):
+    """Test that every available parser backend extracts the same APOD characteristics."""
+
+    def _available(self):
+        return [name for name, available in utility.PARSER_BACKENDS.items() if available]
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, utility.parser_backend, 'nonsense')
+
+    def test_fallback(self):
+        for name, available in utility.PARSER_BACKENDS.items():
+            expected = name if available else 'html.parser'
+            self.assertEqual(utility.parser_backend(name), expected)
+
+    def test_parity(self):
+        for layout, expected in EXPECTED.items():
+            dt = date.fromisoformat(expected['date'])
+            html_content = page_for(dt)
+            for name in self._available():
+                values = utility._apod_chars_from(html_content, dt, parser=name)
+                self.assertEqual(values, expected, layout + ', parsed with ' + name)
+
+    def test_page_without_media(self):
+        html_content = page_for(date(2001, 1, 1))
+        for name in self._available():
+            self.assertRaises(utility.NoMediaError, utility._apod_chars_from, html_content, date(2001, 1, 1),
+                              parser=name)
@@ -0,0 +1,94 @@
+#!/bin/sh/python
+# coding= utf-8
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from apod import scheduler
+from datetime import date, datetime
+
+
+class NotUpYet(scheduler.Scheduler):
+
+    def publish(self, dt):
+        raise ValueError('404')
+
+
+class TestScheduler(unittest.TestCase):
+    """Test the prefetching of the new day's entry."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.folder, 'scheduler.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_single_leader(self):
+        leader = scheduler.Scheduler(self.lock_path)
+        standby = scheduler.Scheduler(self.lock_path)
+        self.assertTrue(leader.is_leader())
+        self.assertFalse(standby.is_leader())
+        self.assertTrue(leader.is_leader())
+
+    def test_backoff(self):
+        poller = NotUpYet(self.lock_path, poll_interval=10, max_interval=35)
+        now = datetime(2020, 5, 1, 0, 1, tzinfo=scheduler.EASTERN)
+        with mock.patch.object(scheduler, 'eastern_now', return_value=now), \
+                mock.patch.object(scheduler.utility, 'cached_json_exists_for', return_value=False):
+            self.assertEqual([poller.run_once() for _ in range(4)], [10, 20, 35, 35])
+
+    def test_started_again_in_forked_processes(self):
+        with mock.patch.object(scheduler, 'Scheduler') as made, \
+                mock.patch.object(scheduler, '_scheduler', scheduler.perprocess.PerProcess(scheduler._started)):
+            self.assertIs(scheduler.start(), scheduler.start())
+            self.assertEqual(made.call_count, 1)
+
+            pid = os.fork()
+            if pid == 0:
+                # the parent's thread didn't come along
+                scheduler.start()
+                scheduler.start()
+                os._exit(0 if made.call_count == 2 else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(made.call_count, 1)
+
+    def test_rollover(self):
+        now = datetime(2020, 5, 1, 23, 59, 30, tzinfo=scheduler.EASTERN)
+        self.assertEqual(scheduler.seconds_until_rollover(now), 30)
+
+    def test_refresh_pushes_expiry_back(self):
+        utility = scheduler.utility
+        today = date.today()
+        # its own caches, today's page cached and about to expire
+        stores = dict((name, utility.store.FileStore(os.path.join(self.folder, name), utility._json_filename_for))
+                      for name in ['_json_store', '_html_store', '_meta_store'])
+        stores.update(_json_memory_cache=utility.LRUCache(10), fulltext_index=None,
+                      keyword_index=utility.search.KeywordIndex(os.path.join(self.folder, 'keywords.log')))
+        for name, value in stores.items():
+            patch = mock.patch.object(utility, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        utility._cache_html('<html></html>', today)
+        utility._meta_store.put(today, json.dumps({'checked': time.time() - utility.RECENT_TTL + 30,
+                                                   'etag': '"1"'}).encode('utf-8'))
+        utility.cache_json({'date': today.isoformat(), 'title': 'Today'}, today)
+
+        noon = datetime(today.year, today.month, today.day, 12, tzinfo=scheduler.EASTERN)
+        not_modified = mock.Mock(status_code=304, headers={})
+        with mock.patch.object(scheduler, 'eastern_now', return_value=noon), \
+                mock.patch.object(utility, '_http_get', return_value=not_modified) as http_get, \
+                mock.patch.object(utility, '_apod_chars_from', return_value={'date': today.isoformat()}):
+            poller = scheduler.Scheduler(self.lock_path)
+            wait = poller.run_once()
+            # revalidated upstream, so not due again before the next window
+            self.assertEqual(http_get.call_count, 1)
+            self.assertEqual(http_get.call_args[0][1], {'If-None-Match': '"1"'})
+            self.assertGreater(wait, utility.RECENT_TTL - 120)
+            self.assertGreater(utility._expiry_for(today), time.time() + utility.RECENT_TTL - 5)
+
+            poller.run_once()
+            self.assertEqual(http_get.call_count, 1)
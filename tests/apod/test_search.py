@@ -0,0 +1,99 @@
+#!/bin/sh/python
+# coding= utf-8
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from apod import search
+from datetime import date
+
+
+class TestKeywordIndex(unittest.TestCase):
+    """Test the keyword index of the cached entries."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'keywords.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_lookup(self):
+        index = search.KeywordIndex(self.path)
+        index.add(date(2001, 1, 12), ['nebula'])
+        index.add_many([(date(2001, 1, 10), ['Nebula', 'orion']), (date(2001, 1, 14), ['galaxy'])])
+
+        self.assertEqual(index.dates_for('NEBULA'), [date(2001, 1, 10), date(2001, 1, 12)])
+        self.assertEqual(index.dates_for('nebula', start_dt=date(2001, 1, 11)), [date(2001, 1, 12)])
+        self.assertEqual(index.dates_for('nebula', end_dt=date(2001, 1, 11)), [date(2001, 1, 10)])
+        self.assertEqual(index.dates_for('comet'), [])
+
+    def test_replaced_keywords(self):
+        index = search.KeywordIndex(self.path)
+        index.add(date(2001, 1, 10), ['nebula'])
+        index.add(date(2001, 1, 10), ['galaxy'])
+
+        self.assertEqual(index.dates_for('nebula'), [])
+        self.assertEqual(index.dates_for('galaxy'), [date(2001, 1, 10)])
+
+    def test_shared_log(self):
+        # e.g. two gunicorn workers
+        writer = search.KeywordIndex(self.path)
+        reader = search.KeywordIndex(self.path)
+        writer.add(date(2001, 1, 10), ['nebula'])
+        self.assertEqual(reader.dates_for('nebula'), [date(2001, 1, 10)])
+
+        writer.rebuild([(date(2001, 1, 12), ['nebula'])])
+        self.assertEqual(reader.dates_for('nebula'), [date(2001, 1, 12)])
+        reader.add(date(2001, 1, 14), ['nebula'])
+        self.assertEqual(writer.dates_for('nebula'), [date(2001, 1, 12), date(2001, 1, 14)])
+
+
+    def test_sample(self):
+        index = search.KeywordIndex(self.path)
+        index.add_many([(date(2001, 1, 10), ['nebula']), (date(2001, 1, 12), None), (date(2001, 1, 14), [])])
+
+        self.assertEqual(sorted(index.sample(5)), [date(2001, 1, 10), date(2001, 1, 12), date(2001, 1, 14)])
+        self.assertEqual(len(set(index.sample(2))), 2)
+        self.assertEqual(sorted(search.KeywordIndex(self.path).sample(3)), sorted(index.sample(3)))
+
+@unittest.skipUnless(search.FullTextIndex.available(), 'SQLite has no FTS5')
+class TestFullTextIndex(unittest.TestCase):
+    """Test the full-text index of the cached entries."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.index = search.FullTextIndex(os.path.join(self.folder, 'fulltext.sqlite'))
+        self.index.add_many([
+            (date(2001, 1, 10), {'title': 'Orion Nebula', 'explanation': 'A bright nebula in Orion.'}),
+            (date(2001, 1, 12), {'title': 'Crab', 'explanation': 'The Crab nebula is a supernova remnant.',
+                                 'copyright': 'R. Gendler'}),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_search(self):
+        self.assertEqual(sorted(self.index.search('NEBULA')), [date(2001, 1, 10), date(2001, 1, 12)])
+        self.assertEqual(self.index.search('orion nebula'), [date(2001, 1, 10)])
+        self.assertEqual(self.index.search('gendler'), [date(2001, 1, 12)])
+        self.assertEqual(self.index.search('nebula', start_dt=date(2001, 1, 11)), [date(2001, 1, 12)])
+        self.assertEqual(len(self.index.search('nebula', limit=1, offset=1)), 1)
+        # query syntax is taken literally
+        self.assertEqual(self.index.search('"crab OR'), [])
+
+    def test_replaced_entry(self):
+        self.index.add(date(2001, 1, 12), {'title': 'Crab', 'explanation': 'A pulsar.'})
+        self.assertEqual(self.index.search('nebula'), [date(2001, 1, 10)])
+        self.assertEqual(self.index.search('pulsar'), [date(2001, 1, 12)])
+
+    def test_rebuild_releases_the_database(self):
+        self.index.rebuild([(date(2001, 1, 10), {'title': 'Orion Nebula'})])
+        # e.g. another worker caching an entry, without waiting for the lock
+        connection = sqlite3.connect(self.index.path, timeout=0)
+        with connection:
+            connection.execute("INSERT INTO entries (rowid, title) VALUES (?, 'Crab Nebula')",
+                               (date(2001, 1, 11).toordinal(),))
+        connection.close()
+        self.assertEqual(sorted(self.index.search('nebula')), [date(2001, 1, 10), date(2001, 1, 11)])
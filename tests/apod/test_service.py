@@ -0,0 +1,405 @@
+#!/bin/sh/python
+# coding= utf-8
+import json
+import os
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+from datetime import date, timedelta
+from urllib.parse import parse_qsl, urlsplit
+
+# the service imports its siblings as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'apod'))
+import search
+import service
+import store
+import utility
+
+
+def entry_for(dt, **fields):
+    data = {'date': dt.isoformat(), 'title': 'Entry of ' + dt.isoformat(), 'explanation': 'A nebula.',
+            'media_type': 'image', 'url': 'https://apod.nasa.gov/apod/image/' + dt.isoformat() + '.jpg'}
+    data.update(fields)
+    return data
+
+
+class ServiceTestCase(unittest.TestCase):
+    """Runs the service against caches of its own, in a temporary folder."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+        def folder(name):
+            return os.path.join(self.folder, name)
+
+        stores = {
+            '_json_store': store.FileStore(folder('json'), utility._json_filename_for),
+            '_html_store': store.FileStore(folder('html'), utility._html_filename_for),
+            '_negative_store': store.FileStore(folder('negative'), utility._json_filename_for),
+            '_meta_store': store.FileStore(folder('meta'), utility._json_filename_for),
+            '_body_stores': dict((encoding, store.FileStore(folder(encoding), utility._body_filename_for(encoding)))
+                                 for encoding in utility.BODY_ENCODINGS),
+            '_json_memory_cache': utility.LRUCache(100),
+            'keyword_index': search.KeywordIndex(folder('keywords.log')),
+            'fulltext_index': None,
+            'compact_archive': None,
+            '_thumbs_store': store.FileStore(folder('thumbs'), lambda key: f"{key}.json"),
+            '_thumbs_memory': {},
+            '_thumbs_retried': set(),
+        }
+        for name, value in stores.items():
+            patch = mock.patch.object(utility, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # nothing is ever fetched from apod.nasa.gov
+        self.upstream_html = utility._get_apod_html
+        patch = mock.patch.object(utility, '_get_apod_html', side_effect=AssertionError('fetched from upstream'))
+        self.get_html = patch.start()
+        self.addCleanup(patch.stop)
+
+        self.client = service.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def seed(self, *dates, **fields):
+        for dt in dates:
+            utility.cache_json(entry_for(dt, **fields), dt)
+
+    def get(self, headers=None, **args):
+        return self.client.get('/v2/apod/', query_string=args, headers=headers or {})
+
+    def get_json(self, **args):
+        response = self.get(**args)
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data.decode('utf-8'))
+
+
+class TestRanges(ServiceTestCase):
+    """Test the date ranges."""
+
+    def test_known_unusable_dates_are_skipped(self):
+        self.seed(date(2001, 1, 1), date(2001, 1, 3))
+        utility._remember_failure(date(2001, 1, 2), utility.NoMediaError('flash only'))
+
+        entries = self.get_json(start_date='2001-01-01', end_date='2001-01-03')
+        self.assertEqual([entry['date'] for entry in entries], ['2001-01-01', '2001-01-03'])
+        self.assertFalse(self.get_html.called)
+
+    def _concurrently(self, first, second):
+        # the first request fetches the (uncached) date, the second one comes
+        # in meanwhile and waits for it
+        fetching, release = threading.Event(), threading.Event()
+
+        def get_html(dt, revalidate=False):
+            fetching.set()
+            release.wait(5)
+            return '<html></html>'
+
+        responses = {}
+
+        def request(args):
+            response = service.app.test_client().get('/v2/apod/', query_string=args)
+            responses[tuple(args)] = (response.status_code, json.loads(response.data.decode('utf-8')))
+
+        with mock.patch.object(utility, '_get_apod_html', side_effect=get_html) as fetched, \
+                mock.patch.object(utility, '_apod_chars_from', side_effect=lambda html, dt: entry_for(dt)):
+            threads = [threading.Thread(target=request, args=(args,)) for args in [first, second]]
+            threads[0].start()
+            self.assertTrue(fetching.wait(5))
+            threads[1].start()
+            time.sleep(0.2)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(fetched.call_count, 1)
+        return responses
+
+    def test_range_and_single_date_share_a_fetch(self):
+        single = {'date': '2001-01-01'}
+        period = {'start_date': '2001-01-01', 'end_date': '2001-01-01'}
+
+        for first, second in [(period, single), (single, period)]:
+            utility._json_memory_cache.clear()
+            utility._json_store.delete(date(2001, 1, 1))
+            responses = self._concurrently(first, second)
+            self.assertEqual(responses[tuple(single)], (200, dict(entry_for(date(2001, 1, 1)), service_version='v2')))
+            self.assertEqual(responses[tuple(period)], (200, [entry_for(date(2001, 1, 1))]))
+
+
+class TestPrefetch(ServiceTestCase):
+    """Test where the prefetching scheduler runs."""
+
+    def test_started_by_the_serving_processes(self):
+        self.seed(date(2001, 1, 1))
+        with mock.patch.object(service.scheduler, 'PREFETCH', True), \
+                mock.patch.object(service.scheduler, 'start') as start:
+            self.get(date='2001-01-01')
+        self.assertTrue(start.called)
+
+
+class TestPages(ServiceTestCase):
+    """Test the pages (count and cursor) of ranges and the projection of entries."""
+
+    def _page(self, **args):
+        response = self.get(**args)
+        self.assertEqual(response.status_code, 200, response.data)
+        dates = [entry['date'] for entry in json.loads(response.data.decode('utf-8'))]
+        link = response.headers.get('Link')
+        if link is None:
+            return dates, None
+        self.assertTrue(link.endswith('>; rel="next"'), link)
+        return dates, dict(parse_qsl(urlsplit(link[1:link.index('>')]).query))
+
+    def test_pages(self):
+        self.seed(*[date(2001, 1, day) for day in range(1, 11) if day != 3])
+        utility._remember_failure(date(2001, 1, 3), utility.NoMediaError('flash only'))
+
+        dates, next_page = self._page(start_date='2001-01-01', end_date='2001-01-10', count=4)
+        self.assertEqual(dates, ['2001-01-01', '2001-01-02', '2001-01-04', '2001-01-05'])
+        self.assertEqual(next_page, {'start_date': '2001-01-01', 'end_date': '2001-01-10', 'count': '4',
+                                     'cursor': '2001-01-06'})
+        dates, next_page = self._page(**next_page)
+        self.assertEqual(dates, ['2001-01-06', '2001-01-07', '2001-01-08', '2001-01-09'])
+        dates, next_page = self._page(**next_page)
+        self.assertEqual(dates, ['2001-01-10'])
+        self.assertIsNone(next_page)
+
+    def test_invalid_pages(self):
+        self.assertEqual(self.get(start_date='2001-01-01', end_date='2001-01-10', count=0).status_code, 400)
+        self.assertEqual(self.get(start_date='2001-01-01', end_date='2001-01-10', count=4,
+                                  cursor='2001-01-11').status_code, 400)
+        self.assertEqual(self.get(date='2001-01-01', cursor='2001-01-01').status_code, 400)
+
+    def test_fields(self):
+        self.seed(date(2001, 1, 1), date(2001, 1, 2))
+        entries = self.get_json(start_date='2001-01-01', end_date='2001-01-02', fields='date,title')
+        self.assertEqual(entries, [{'date': '2001-01-01', 'title': 'Entry of 2001-01-01'},
+                                   {'date': '2001-01-02', 'title': 'Entry of 2001-01-02'}])
+        self.assertEqual(set(self.get_json(date='2001-01-01', fields='url')), {'url', 'service_version'})
+
+        dates, next_page = self._page(start_date='2001-01-01', end_date='2001-01-02', count=1, fields='date')
+        self.assertEqual(next_page['fields'], 'date')
+        self.assertEqual(self.get(date='2001-01-01', fields='date,colour').status_code, 400)
+
+    def test_pages_fetch_no_more_than_they_return(self):
+        fetched = []
+
+        class Fetcher(object):
+            def map(self, dates, cache=True):
+                # like the fetcher's, submits every download right away
+                fetched.extend(dt for dt, use_default_today_date in dates)
+                return (entry_for(dt) for dt, use_default_today_date in dates)
+
+        with mock.patch.object(service, 'fetcher', return_value=Fetcher()):
+            dates, next_page = self._page(start_date='2001-01-01', end_date='2001-12-31', count=5)
+
+        self.assertEqual(len(dates), 5)
+        self.assertEqual(fetched, [date(2001, 1, day) for day in range(1, 6)])
+        self.assertEqual(next_page['cursor'], '2001-01-06')
+
+
+class TestConditionalRequests(ServiceTestCase):
+    """Test the ETag and Cache-Control headers of single dates."""
+
+    def test_not_modified(self):
+        self.seed(date(2001, 1, 1))
+        response = self.get(date='2001-01-01')
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.get(date='2001-01-01', headers={'If-None-Match': etag}).status_code, 304)
+        # also when the entry has to be read from the store again
+        utility._json_memory_cache.clear()
+        response = self.get(date='2001-01-01', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.get(date='2001-01-01', headers={'If-None-Match': '"v2-other"'}).status_code, 200)
+
+    def test_tags_differ_between_encodings(self):
+        self.seed(date(2001, 1, 1))
+        identity = self.get(date='2001-01-01')
+        gzipped = self.get(date='2001-01-01', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(zlib.decompress(gzipped.data, 16 + zlib.MAX_WBITS).decode('utf-8')),
+                         json.loads(identity.data.decode('utf-8')))
+        self.assertNotEqual(identity.headers['ETag'], gzipped.headers['ETag'])
+
+        # a tag of any encoding tells that the entry didn't change
+        for etag in [identity.headers['ETag'], gzipped.headers['ETag']]:
+            response = self.get(date='2001-01-01', headers={'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], gzipped.headers['ETag'])
+            self.assertEqual(self.get(date='2001-01-01', headers={'If-None-Match': etag}).status_code, 304)
+
+    def test_projected_tags_differ_between_encodings(self):
+        self.seed(date(2001, 1, 1), explanation='A nebula. ' * 100)
+        identity = self.get(date='2001-01-01', fields='date,explanation')
+        gzipped = self.get(date='2001-01-01', fields='date,explanation', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertNotEqual(identity.headers['ETag'], gzipped.headers['ETag'])
+        response = self.get(date='2001-01-01', fields='date,explanation',
+                            headers={'If-None-Match': identity.headers['ETag'], 'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_past_dates_are_immutable(self):
+        self.seed(date(2001, 1, 1))
+        response = self.get(date='2001-01-01')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=%d, immutable' % service.IMMUTABLE_MAX_AGE)
+
+    def test_recent_dates_expire(self):
+        today = date.today()
+        utility._meta_store.put(today, json.dumps({'checked': time.time()}).encode('utf-8'))
+        self.seed(today)
+
+        response = self.get(date=today.isoformat())
+        self.assertEqual(response.status_code, 200)
+        cache_control = response.headers['Cache-Control']
+        self.assertNotIn('immutable', cache_control)
+        self.assertTrue(0 < int(cache_control.split('max-age=')[1]) <= utility.RECENT_TTL, cache_control)
+
+
+class TestFreshness(ServiceTestCase):
+    """Test when cached entries have to be revalidated."""
+
+    def test_expiry(self):
+        today = date.today()
+        self.assertIsNone(utility._expiry_for(date(2001, 1, 1)))
+        # never checked: due right away
+        self.assertEqual(utility._expiry_for(today), 0)
+        utility._meta_store.put(today, json.dumps({'checked': 1000.0}).encode('utf-8'))
+        self.assertEqual(utility._expiry_for(today), 1000.0 + utility.RECENT_TTL)
+
+    def test_fallback_is_not_stored_under_today(self):
+        today, yesterday = date.today(), date.today() - timedelta(days=1)
+
+        def apod_chars(dt):
+            if dt == today:
+                raise ValueError('not up yet')
+            return entry_for(dt)
+
+        with mock.patch.object(utility, '_get_apod_chars', side_effect=apod_chars) as get_apod_chars:
+            response = self.get(headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('max-age', response.headers['Cache-Control'])
+            self.assertLessEqual(int(response.headers['Cache-Control'].split('max-age=')[1]), utility.FALLBACK_TTL)
+
+            # cached under its own date only
+            self.assertTrue(utility._json_store.exists(yesterday))
+            self.assertFalse(utility._json_store.exists(today))
+            self.assertFalse(utility._body_stores['gzip'].exists(today))
+            self.assertTrue(utility._is_fallback(utility.cached_json_for(today), today))
+
+            # served for FALLBACK_TTL, then today's page is looked for again
+            calls = get_apod_chars.call_count
+            self.get()
+            self.assertEqual(get_apod_chars.call_count, calls)
+            with mock.patch.object(utility, 'FALLBACK_TTL', 0):
+                utility._json_memory_cache.clear()
+                self.get()
+            self.assertGreater(get_apod_chars.call_count, calls)
+
+    def test_stale_when_upstream_fails(self):
+        today = date.today()
+        utility._cache_html('<html></html>', today)
+        utility._meta_store.put(today, json.dumps({'checked': time.time() - utility.RECENT_TTL - 1}).encode('utf-8'))
+        self.seed(today)
+
+        with mock.patch.object(utility, '_get_apod_html', self.upstream_html), \
+                mock.patch.object(utility, '_http_get', side_effect=requests.ConnectionError('down')) as http_get, \
+                mock.patch.object(utility, '_apod_chars_from', side_effect=lambda html, dt: entry_for(dt)):
+            self.assertEqual(self.get_json(date=today.isoformat())['date'], today.isoformat())
+            self.assertEqual(self.get_json()['date'], today.isoformat())
+            self.assertEqual(self.get_json(start_date=today.isoformat()), [entry_for(today)])
+            # tried once, then left alone for another RECENT_TTL
+            self.assertEqual(http_get.call_count, 1)
+        self.assertGreater(utility._expiry_for(today), time.time() + utility.RECENT_TTL - 5)
+
+    def test_unchanged_entries_are_not_rewritten(self):
+        today = date.today()
+        self.seed(today)
+        with mock.patch.object(utility._json_store, 'put') as put, \
+                mock.patch.object(utility.keyword_index, 'add_many') as add:
+            self.seed(today)
+            self.assertFalse(put.called)
+            self.assertFalse(add.called)
+            self.seed(today, title='Another title')
+            self.assertTrue(put.called)
+            self.assertTrue(add.called)
+
+VIMEO = 'https://player.vimeo.com/video/1234'
+THUMBNAIL = 'https://i.vimeocdn.com/video/1234_640.jpg'
+
+
+class TestThumbnails(ServiceTestCase):
+    """Test the entries of Vimeo videos cached before their thumbnail was found."""
+
+    def _cache_video(self, dt):
+        # as _apod_chars_from does it
+        future = utility._thumbnail_executor().submit(utility._get_thumbs, VIMEO)
+        self.seed(dt, media_type='video', url=VIMEO, thumbnail_url=utility._thumbnail_of(future))
+        return future
+
+    def _thumbnails(self, **args):
+        entries = self.get_json(**args)
+        return [entry['thumbnail_url'] for entry in (entries if isinstance(entries, list) else [entries])]
+
+    def test_slow_lookup(self):
+        release = threading.Event()
+
+        def slow_lookup(vimeo_id):
+            release.wait(5)
+            return THUMBNAIL
+
+        with mock.patch.object(utility, '_vimeo_thumbnail', side_effect=slow_lookup), \
+                mock.patch.object(utility, 'THUMBNAIL_TIMEOUT', 0.05):
+            future = self._cache_video(date(2001, 1, 1))
+            self.assertEqual(self._thumbnails(date='2001-01-01'), [None])
+            release.set()
+            future.result(5)
+
+        # the thumbnail that came in late is added to the cached entry
+        self.assertEqual(self._thumbnails(date='2001-01-01'), [THUMBNAIL])
+        utility._json_memory_cache.clear()
+        self.assertEqual(self._thumbnails(start_date='2001-01-01', end_date='2001-01-01'), [THUMBNAIL])
+        self.assertEqual(json.loads(utility._json_store.get(date(2001, 1, 1)).decode('utf-8'))['thumbnail_url'],
+                         THUMBNAIL)
+
+    def test_failed_lookup(self):
+        with mock.patch.object(utility, '_vimeo_thumbnail',
+                               side_effect=[requests.ConnectionError(), THUMBNAIL]) as lookup:
+            self._cache_video(date(2001, 1, 1))
+            # looked up again (once) in the background
+            self.assertEqual(self._thumbnails(start_date='2001-01-01', end_date='2001-01-01'), [None])
+            deadline = time.time() + 5
+            while self._thumbnails(date='2001-01-01') != [THUMBNAIL] and time.time() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual(self._thumbnails(date='2001-01-01'), [THUMBNAIL])
+        self.assertEqual(lookup.call_count, 2)
+
+
+class TestSearch(ServiceTestCase):
+    """Test the full-text search endpoint."""
+
+    def test_unavailable(self):
+        response = self.client.get('/v2/apod/search', query_string={'q': 'nebula'})
+        self.assertEqual(response.status_code, 501)
+        self.assertRaises(search.SearchUnavailable, utility.fulltext_dates, 'nebula')
+
+    def test_index_failures_are_not_fatal(self):
+        self.seed(date(2001, 1, 1))
+        with mock.patch.object(utility.keyword_index, 'add_many', side_effect=OSError(28, 'No space left on device')), \
+                mock.patch.object(utility, 'fulltext_index', mock.Mock(**{'add_many.side_effect': Exception('locked')})):
+            self.seed(date(2001, 1, 1), title='Another title')
+            utility.cache_json_many([(entry_for(date(2001, 1, 2)), date(2001, 1, 2))])
+        self.assertEqual(self.get_json(date='2001-01-01')['title'], 'Another title')
+        self.assertEqual(self.get_json(date='2001-01-02')['date'], '2001-01-02')